@@ -1,14 +1,25 @@
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
+import click
 from flask import Flask, request, current_app
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
+from werkzeug.middleware.proxy_fix import ProxyFix
 from config import Config
+from app import database
+from app.last_seen import LastSeenTracker
+from app.language import LanguageDetector
+from app.fragments import FragmentCache
+from app.identity import IdentityCache
+from app.instrumentation import Instrumentation
+from app.ratelimit import RateLimiter
+from app.suggestions import FollowSuggestions
+from app.events import EventStream
+from app.archive import PostArchive
 
 
 def get_locale():
@@ -16,25 +27,52 @@ def get_locale():
 
 
 db = SQLAlchemy()
-migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page.')
+# API clients get a 401 instead of a redirect to the login page
+login.blueprint_login_views = {'api': None}
 mail = Mail()
 moment = Moment()
 babel = Babel()
+last_seen_tracker = LastSeenTracker()
+language_detector = LanguageDetector()
+fragment_cache = FragmentCache()
+identity_cache = IdentityCache()
+instrumentation = Instrumentation()
+rate_limiter = RateLimiter()
+follow_suggestions = FollowSuggestions()
+event_stream = EventStream()
+post_archive = PostArchive()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                                x_proto=app.config['TRUSTED_PROXIES'])
 
+    database.configure(app)
     db.init_app(app)
-    migrate.init_app(app, db)
+    database.init_engines(app, db)
+    if click.get_current_context(silent=True) is not None:
+        # Flask-Migrate imports alembic, which only the flask commands need
+        from flask_migrate import Migrate
+        Migrate(app, db)
     login.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
+    last_seen_tracker.init_app(app)
+    language_detector.init_app(app)
+    fragment_cache.init_app(app)
+    identity_cache.init_app(app)
+    instrumentation.init_app(app)
+    rate_limiter.init_app(app)
+    follow_suggestions.init_app(app)
+    event_stream.init_app(app)
+    post_archive.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -45,6 +83,9 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+
     from app.cli import bp as cli_bp
     app.register_blueprint(cli_bp)
 
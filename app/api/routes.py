@@ -0,0 +1,129 @@
+import json
+from datetime import timezone
+from types import SimpleNamespace
+from flask import Response, abort, current_app, request, stream_with_context
+from flask_login import current_user, login_required
+import sqlalchemy as sa
+from app import db, post_archive
+from app.api import bp
+from app.database import replica_bind, read_primary_for_a_while
+from app.models import User, Post
+from app.pagination import encode_cursor, seek
+
+# the only columns the API returns, read as plain rows instead of Post objects
+POST_COLUMNS = (Post.id, Post.body, Post.timestamp, Post.language,
+                User.username, User.avatar_hash)
+
+
+def http_error(error):
+    return {'error': error.name, 'message': error.description}, error.code
+
+
+# registered by code, since the HTML handlers of the errors blueprint are too
+for code in (400, 401, 403, 404, 405, 415):
+    bp.register_error_handler(code, http_error)
+
+
+def serialize(row):
+    return {
+        'id': row.id,
+        'body': row.body,
+        'timestamp': row.timestamp.replace(tzinfo=timezone.utc).isoformat(),
+        'language': row.language or None,
+        'author': {'username': row.username, 'avatar': User.avatar_url(row.avatar_hash, 70)},
+    }
+
+
+def page_size():
+    return max(1, min(request.args.get('per_page', current_app.config['POSTS_PER_PAGE'],
+                                       type=int), 100))
+
+
+def stream_posts(query, columns):
+    """Stream a page of a Post query as JSON, one post at a time.
+
+    The response is {"posts": [...], "next_cursor": ...} with the cursor
+    sent last, once the extra row that tells if there is a next page has
+    been read.
+    """
+    per_page = page_size()
+    query = seek(query.with_only_columns(*POST_COLUMNS).join(User, User.id == Post.user_id),
+                 columns, request.args.get('cursor')).limit(per_page + 1)
+    bind_arguments = replica_bind()
+
+    def generate():
+        yield '{"posts":['
+        last = None
+        next_cursor = None
+        for count, row in enumerate(db.session.execute(query, bind_arguments=bind_arguments)):
+            if count == per_page:
+                next_cursor = encode_cursor('next', [last.timestamp, last.id])
+                break
+            yield (',' if count else '') + json.dumps(serialize(row))
+            last = row
+        yield '],"next_cursor":{}}}'.format(json.dumps(next_cursor))
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def get_user(username):
+    user = db.session.scalar(sa.select(User).where(User.username == username))
+    if user is None:
+        abort(404, 'User {} not found.'.format(username))
+    return user
+
+
+@bp.route('/timeline')
+@login_required
+def timeline():
+    return stream_posts(current_user.timeline_posts(), User.timeline_columns())
+
+
+@bp.route('/explore')
+@login_required
+def explore():
+    return stream_posts(sa.select(Post), (Post.timestamp, Post.id))
+
+
+@bp.route('/users/<username>/posts')
+@login_required
+def user_posts(username):
+    user = get_user(username)
+    if not post_archive.partitions():
+        return stream_posts(user.posts.select(), (Post.timestamp, Post.id))
+    # older posts are in the archive tables, so the page is merged from them
+    page = post_archive.user_posts(user, cursor=request.args.get('cursor'),
+                                   per_page=page_size(), bind_arguments=replica_bind())
+    return {'posts': [serialize(SimpleNamespace(
+                id=post.id, body=post.body, timestamp=post.timestamp, language=post.language,
+                username=user.username, avatar_hash=user.avatar_hash)) for post in page.items],
+            'next_cursor': page.next_cursor}
+
+
+def change_following(username, follow):
+    # a JSON body cannot be sent cross-site without CORS, so no CSRF token is needed
+    if not request.is_json:
+        abort(415, 'Send the request with a JSON content type.')
+    user = get_user(username)
+    if user == current_user:
+        abort(400, 'You cannot follow yourself.')
+    if follow:
+        current_user.follow(user)
+    else:
+        current_user.unfollow(user)
+    db.session.commit()
+    read_primary_for_a_while()
+    return {'username': user.username, 'following': follow,
+            'followers_count': user.followers_count}
+
+
+@bp.route('/users/<username>/follow', methods=['POST'])
+@login_required
+def follow(username):
+    return change_following(username, True)
+
+
+@bp.route('/users/<username>/unfollow', methods=['POST'])
+@login_required
+def unfollow(username):
+    return change_following(username, False)
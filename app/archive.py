@@ -0,0 +1,211 @@
+import heapq
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+import sqlalchemy as sa
+
+
+class ArchivedPost:
+    """A post read from an archive table, with what _post.html needs."""
+
+    def __init__(self, row, author):
+        self.id = row.id
+        self.body = row.body
+        self.timestamp = row.timestamp
+        self.language = row.language
+        self.user_id = row.user_id
+        self.author = author
+
+    def __repr__(self):
+        return '<ArchivedPost {}>'.format(self.body)
+
+
+class PostArchive:
+    """Moves old posts out of the post table into one archive table per month.
+
+    Posts older than POST_RETENTION_DAYS are copied to post_archive_YYYYMM
+    and deleted from post, together with their timeline and search rows,
+    ARCHIVE_BATCH_SIZE posts per background job. The post_partition table
+    lists the archive tables with the time range they hold; it is read at
+    most once a minute by each process.
+    """
+
+    catalog_ttl = 60
+
+    def __init__(self, app=None):
+        self.app = None
+        self.metadata = sa.MetaData()
+        self._catalog = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from app.jobs import job
+        self.app = app
+        self._catalog = None
+        job('archive_posts')(self.run_job)
+
+    def table(self, month):
+        name = 'post_archive_' + month.replace('-', '')
+        if name not in self.metadata.tables:
+            sa.Table(name, self.metadata,
+                     sa.Column('id', sa.Integer, primary_key=True),
+                     sa.Column('body', sa.String(140)),
+                     sa.Column('timestamp', sa.DateTime),
+                     sa.Column('user_id', sa.Integer),
+                     sa.Column('language', sa.String(5)),
+                     sa.Index('ix_{}_user_id_timestamp'.format(name), 'user_id', 'timestamp'))
+        return self.metadata.tables[name]
+
+    def partitions(self):
+        """The archive partitions as (month, oldest, newest), newest month first."""
+        from app import db
+        from app.models import PostPartition
+        if self._catalog is None or self._catalog[0] < monotonic():
+            partitions = db.session.scalars(
+                sa.select(PostPartition).order_by(PostPartition.month.desc())).all()
+            self._catalog = (monotonic() + self.catalog_ttl,
+                             [(p.month, p.oldest, p.newest) for p in partitions])
+        return self._catalog[1]
+
+    def cutoff(self, days=None):
+        days = self.app.config['POST_RETENTION_DAYS'] if days is None else days
+        return datetime.now(timezone.utc) - timedelta(days=days) if days else None
+
+    def plan(self, cutoff):
+        """Posts older than ``cutoff`` as (year, month, count) rows, oldest first."""
+        from app import db
+        from app.models import Post
+        year = sa.extract('year', Post.timestamp)
+        month = sa.extract('month', Post.timestamp)
+        return db.session.execute(
+            sa.select(year, month, sa.func.count()).where(Post.timestamp < cutoff)
+            .group_by(year, month).order_by(year, month)).all()
+
+    def archive_batch(self, cutoff, batch_size=None):
+        """Move up to ``batch_size`` of the oldest posts before ``cutoff``, returns how many."""
+        from app import db
+        from app.models import Post, PostPartition, Timeline
+        from app.search import get_search_index
+        batch_size = batch_size or self.app.config['ARCHIVE_BATCH_SIZE']
+        rows = db.session.execute(
+            sa.select(Post.id, Post.body, Post.timestamp, Post.user_id, Post.language)
+            .where(Post.timestamp < cutoff).order_by(Post.timestamp, Post.id)
+            .limit(batch_size)).all()
+        if not rows:
+            return 0
+        months = {}
+        for row in rows:
+            months.setdefault(row.timestamp.strftime('%Y-%m'), []).append(row)
+        for month, month_rows in months.items():
+            table = self.table(month)
+            table.create(db.session.connection(), checkfirst=True)
+            db.session.execute(sa.insert(table), [row._asdict() for row in month_rows])
+            partition = db.session.get(PostPartition, month)
+            if partition is None:
+                partition = PostPartition(month=month, table_name=table.name, post_count=0,
+                                          oldest=month_rows[0].timestamp,
+                                          newest=month_rows[-1].timestamp)
+                db.session.add(partition)
+            partition.post_count += len(month_rows)
+            partition.oldest = min(partition.oldest, month_rows[0].timestamp)
+            partition.newest = max(partition.newest, month_rows[-1].timestamp)
+        ids = [row.id for row in rows]
+        db.session.execute(sa.delete(Timeline).where(Timeline.post_id.in_(ids)))
+        get_search_index().remove(ids)
+        db.session.execute(sa.delete(Post).where(Post.id.in_(ids)))
+        db.session.commit()
+        self._catalog = None
+        return len(rows)
+
+    def schedule(self, cutoff):
+        """Queue the archiving job, unless one is already queued or running."""
+        from app import db
+        from app.jobs import enqueue
+        from app.models import Job
+        pending = db.session.scalar(sa.select(Job.id).where(
+            Job.kind == 'archive_posts', Job.status.in_(('queued', 'running'))).limit(1))
+        if pending is not None:
+            return None
+        return enqueue('archive_posts', cutoff=cutoff.isoformat(),
+                       batch_size=self.app.config['ARCHIVE_BATCH_SIZE'])
+
+    def count_posts(self, user_column):
+        """A correlated count of the posts of a user across all archive tables."""
+        count = sa.literal(0)
+        for month, _, _ in self.partitions():
+            table = self.table(month)
+            count = count + sa.select(sa.func.count()).where(
+                table.c.user_id == user_column).scalar_subquery()
+        return count
+
+    def user_posts(self, user, cursor=None, page=None, per_page=25, bind_arguments=None):
+        """Paginate the posts of ``user`` newest first, including archived ones.
+
+        The post table is read first; archive tables are only read when the
+        page reaches past the posts it holds. Rows from archive tables are
+        returned as ArchivedPost objects. Old ``?page=N`` links without a
+        cursor are served with an offset into the merged posts.
+        """
+        from app import db
+        from app.models import Post
+        from app.pagination import CursorPagination, cursor_paginate, decode_cursor, _seek
+        columns = (Post.timestamp, Post.id)
+        query = user.posts.select()
+        partitions = self.partitions()
+        decoded = decode_cursor(cursor, columns) if cursor else None
+        if not partitions:
+            return cursor_paginate(query, columns, cursor=cursor, page=page, per_page=per_page,
+                                   bind_arguments=bind_arguments)
+        direction, values = decoded or ('next', None)
+        offset = 0 if decoded else (max(page or 1, 1) - 1) * per_page
+        newest_first = direction == 'next'
+        limit = offset + per_page + 1
+
+        def key(item):
+            return item.timestamp, item.id
+
+        def read(table, source_query, make):
+            source_columns = (table.c.timestamp, table.c.id)
+            if values is not None:
+                source_query = source_query.where(_seek(source_columns, values, newest_first))
+            source_query = source_query.order_by(*[
+                column.desc() if newest_first else column.asc() for column in source_columns])
+            return [make(row) for row in db.session.execute(
+                source_query.limit(limit), bind_arguments=bind_arguments)]
+
+        hot = read(Post.__table__, sa.select(Post).where(Post.user_id == user.id),
+                   lambda row: row[0])
+        # partitions in the order the page walks through them
+        ordered = partitions if newest_first else partitions[::-1]
+        items = hot
+        for month, oldest, newest in ordered:
+            enough = len(items) >= limit
+            if newest_first:
+                if values is not None and oldest > values[0]:
+                    continue
+                if enough and newest < items[limit - 1].timestamp:
+                    break
+            else:
+                if newest < values[0]:
+                    continue
+                if enough and oldest > items[limit - 1].timestamp:
+                    break
+            table = self.table(month)
+            archived = read(table, sa.select(table).where(table.c.user_id == user.id),
+                            lambda row: ArchivedPost(row, user))
+            items = (heapq.nlargest if newest_first else heapq.nsmallest)(
+                limit, items + archived, key=key)
+        if newest_first:
+            items = items[offset:]
+            return CursorPagination(items[:per_page], ('timestamp', 'id'),
+                                    len(items) > per_page, values is not None or offset > 0)
+        if not items:
+            return self.user_posts(user, per_page=per_page, bind_arguments=bind_arguments)
+        return CursorPagination(items[:per_page][::-1], ('timestamp', 'id'),
+                                True, len(items) > per_page)
+
+    def run_job(self, cutoff, batch_size):
+        # moves one batch, then queues the next one until nothing is left to move
+        from app.jobs import enqueue
+        if self.archive_batch(datetime.fromisoformat(cutoff), batch_size) == batch_size:
+            enqueue('archive_posts', cutoff=cutoff, batch_size=batch_size)
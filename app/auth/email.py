@@ -1,12 +1,28 @@
-from flask import render_template, current_app
-from flask_babel import _
-from app.email import send_email
+from flask import render_template, current_app, request
+from flask_babel import _, force_locale, get_locale
+from app import db
+from app.email import send_queued_email
+from app.jobs import enqueue, job
+from app.models import User
+
+
+# the token is made by the worker when the email goes out, so it is never
+# stored in the job table
+@job('send_password_reset_email')
+def send_queued_password_reset_email(user_id, url_root, locale):
+    user = db.session.get(User, user_id)
+    if user is None:
+        return
+    with current_app.test_request_context(base_url=url_root), force_locale(locale):
+        token = user.get_reset_password_token()
+        send_queued_email(_('[Microblog] Reset Your Password'),
+                          sender=current_app.config['ADMINS'][0],
+                          recipients=[user.email],
+                          text_body=render_template('email/reset_password.txt', user=user, token=token),
+                          html_body=render_template('email/reset_password.html', user=user, token=token))
+
 
 # this variable is used to send the password reset email
 def send_password_reset_email(user):
-    token = user.get_reset_password_token()
-    send_email(_('[Microblog] Reset Your Password'),
-               sender=current_app.config['ADMINS'][0],
-               recipients=[user.email],
-               text_body=render_template('email/reset_password.txt', user=user, token=token),
-               html_body=render_template('email/reset_password.html', user=user, token=token))
+    enqueue('send_password_reset_email', user_id=user.id, url_root=request.url_root,
+            locale=str(get_locale() or 'en'))
@@ -3,15 +3,17 @@ from urllib.parse import urlsplit
 from flask_login import login_user, logout_user, current_user
 from flask_babel import _
 import sqlalchemy as sa
-from app import db
+from app import db, rate_limiter
 from app.auth import bp
 from app.auth.forms import LoginForm, RegistrationForm, \
     ResetPasswordRequestForm, ResetPasswordForm
 from app.models import User
 from app.auth.email import send_password_reset_email
+from app.passwords import PasswordCheckBusy
 
 # the web page for login
 @bp.route('/login', methods=['GET', 'POST'])
+@rate_limiter.limit('username')
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('main.index'))
@@ -19,9 +21,17 @@ def login():
     if form.validate_on_submit():
         user = db.session.scalar( # cheks the database for matching usernames
             sa.select(User).where(User.username == form.username.data))
-        if user is None or not user.check_password(form.password.data):
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+        except PasswordCheckBusy:
+            return render_template('errors/503.html'), 503, {'Retry-After': '1'}
+        if not valid:
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
+        if user.password_needs_rehash():
+            # the hash method changed since this password was set
+            user.set_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
@@ -51,6 +61,7 @@ def register():
 
 # this is the website wheer you request a password reset
 @bp.route('/reset_password_request', methods=['GET', 'POST'])
+@rate_limiter.limit('email')
 def reset_password_request():
     if current_user.is_authenticated:
         return redirect(url_for('main.index'))
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import threading
+from flask import current_app
+from app.cache import evict_files
+
+_lock = threading.Lock()
+_session = None
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            _session = requests.Session()
+        return _session
+
+
+def image_type(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    return None
+
+
+def fetch_avatar(digest, size):
+    """Return the path of the cached gravatar image, downloading it if needed.
+
+    Returns None if gravatar could not be reached. Once the cache holds more
+    than AVATAR_CACHE_LIMIT images the oldest downloads are removed.
+    """
+    directory = current_app.config['AVATAR_CACHE_DIR']
+    path = os.path.join(directory, '{}-{}'.format(digest, size))
+    if os.path.exists(path):
+        return path
+    import requests
+    try:
+        r = get_session().get('https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
+            digest, size), timeout=current_app.config['AVATAR_TIMEOUT'])
+    except requests.RequestException:
+        return None
+    if r.status_code != 200 or image_type(r.content) is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(r.content)
+    os.replace(tmp, path)
+    # downloads are rare, so listing the directory after each one is cheap enough
+    evict_files(directory, current_app.config['AVATAR_CACHE_LIMIT'])
+    return path
+
+
+def identicon_svg(digest, size):
+    # a symmetric 5x5 identicon drawn from the digest, used when gravatar is down
+    data = bytes.fromhex(digest)
+    color = '#{:02x}{:02x}{:02x}'.format(data[0], data[1], data[2])
+    bits = int.from_bytes(data[3:5], 'big')
+    cells = []
+    for row in range(5):
+        for col in range(3):
+            if bits >> (row * 3 + col) & 1:
+                for x in sorted({col, 4 - col}):
+                    cells.append('<rect x="{}" y="{}" width="1" height="1"/>'.format(x, row))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{0}" '
+            'viewBox="0 0 5 5" shape-rendering="crispEdges">'
+            '<rect width="5" height="5" fill="#f0f0f0"/><g fill="{1}">{2}</g></svg>').format(
+        size, color, ''.join(cells))
@@ -0,0 +1,149 @@
+import itertools
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from hashlib import md5
+import sqlalchemy as sa
+from app import db
+from app.passwords import hash_password
+from app.models import User, Post, Timeline, followers
+from app.search import get_search_index
+
+PASSWORD = 'bench'
+# how often each kind of request appears in the simulated traffic
+MIX = {'index': 40, 'explore': 15, 'user': 25, 'follow': 10, 'post': 10}
+WORDS = ('the quick brown fox jumps over a lazy dog while people read posts '
+         'about coffee music travel code books rain weekends and friends').split()
+
+
+def zipf_weights(n, exponent=1.0):
+    # cumulative weights that pick rank r in proportion to 1 / r ** exponent
+    return list(itertools.accumulate(1 / (i + 1) ** exponent for i in range(n)))
+
+
+def percentile(values, p):
+    # nearest rank, which also works for the handful of samples of a rare route
+    ordered = sorted(values)
+    return ordered[max(int(round(p / 100 * len(ordered))) - 1, 0)]
+
+
+def seed(users, posts, follows=20, batch_size=10000, rng=None):
+    """Fill an empty database with synthetic users, followers and posts.
+
+    Everything is written with bulk inserts. Followers and post authors are
+    drawn from a Zipf distribution, so a few users are followed by almost
+    everyone and write most of the posts. Counters, timelines and the
+    search index are then rebuilt from the inserted rows.
+    """
+    rng = rng or random.Random()
+    password_hash = hash_password(PASSWORD)
+    for start in range(0, users, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, users)):
+            email = 'user{}@example.com'.format(i)
+            rows.append({'username': 'user{}'.format(i), 'email': email,
+                         'avatar_hash': md5(email.encode('utf-8')).hexdigest(),
+                         'password_hash': password_hash})
+        db.session.execute(sa.insert(User), rows)
+    user_ids = db.session.scalars(sa.select(User.id).order_by(User.id)).all()
+
+    popularity = zipf_weights(len(user_ids))
+    edges = []
+    for follower_id in user_ids:
+        targets = set(rng.choices(user_ids, cum_weights=popularity,
+                                  k=rng.randint(0, 2 * follows)))
+        targets.discard(follower_id)
+        edges.extend({'follower_id': follower_id, 'followed_id': followed_id}
+                     for followed_id in targets)
+        if len(edges) >= batch_size:
+            db.session.execute(sa.insert(followers), edges)
+            edges = []
+    if edges:
+        db.session.execute(sa.insert(followers), edges)
+
+    # a different order so the most followed users are not also the most active
+    authors = rng.sample(user_ids, len(user_ids))
+    now = datetime.now(timezone.utc)
+    for start in range(0, posts, batch_size):
+        count = min(batch_size, posts - start)
+        db.session.execute(sa.insert(Post), [
+            {'body': ' '.join(rng.choices(WORDS, k=rng.randint(3, 20))),
+             'user_id': user_id, 'language': 'en',
+             'timestamp': now - timedelta(seconds=rng.randint(0, 30 * 86400))}
+            for user_id in rng.choices(authors, cum_weights=popularity, k=count)])
+
+    User.repair_counters()
+    Timeline.rebuild()
+    get_search_index().reindex()
+    db.session.commit()
+    return len(user_ids), db.session.scalar(sa.select(sa.func.count()).select_from(followers))
+
+
+def run(app, requests, clients=20, rng=None):
+    """Send a mix of requests to the routes with the test client.
+
+    The app must have WTF_CSRF_ENABLED and RATE_LIMIT_PER_MINUTE turned
+    off. Each of ``clients`` test clients logs in as a random user. Returns
+    a report with the throughput and, for each kind of request, the
+    p50/p95/p99 latency in milliseconds and the mean number of queries.
+    """
+    rng = rng or random.Random()
+    with app.app_context():
+        engine = db.engine
+        users = db.session.scalar(sa.select(sa.func.count()).select_from(User))
+
+    logged_in = []
+    for i in rng.sample(range(users), min(clients, users)):
+        client = app.test_client()
+        client.post('/auth/login', data={'username': 'user{}'.format(i), 'password': PASSWORD})
+        logged_in.append((client, set()))
+
+    queries = 0
+
+    def count(*args):
+        nonlocal queries
+        queries += 1
+
+    samples = {kind: [] for kind in MIX}
+    errors = 0
+    sa.event.listen(engine, 'before_cursor_execute', count)
+    try:
+        started = time.perf_counter()
+        for kind in rng.choices(list(MIX), weights=list(MIX.values()), k=requests):
+            client, followed = rng.choice(logged_in)
+            username = 'user{}'.format(rng.randrange(users))
+            method, url, data = 'GET', '/' + kind, None
+            if kind == 'user':
+                url = '/user/' + username
+            elif kind == 'follow':
+                # alternates so the follower graph stays about the same size
+                method = 'POST'
+                url = '/{}/{}'.format('unfollow' if username in followed else 'follow', username)
+                followed.symmetric_difference_update({username})
+            elif kind == 'post':
+                method, url = 'POST', '/index'
+                data = {'post': ' '.join(rng.choices(WORDS, k=rng.randint(3, 20)))}
+            queries = 0
+            start = time.perf_counter()
+            response = client.open(url, method=method, data=data)
+            samples[kind].append(((time.perf_counter() - start) * 1000, queries))
+            if response.status_code >= 400:
+                errors += 1
+        duration = time.perf_counter() - started
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', count)
+
+    routes = {}
+    for kind, values in samples.items():
+        if not values:
+            continue
+        latencies = [latency for latency, _ in values]
+        routes[kind] = {
+            'requests': len(values),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'queries': sum(q for _, q in values) / len(values),
+        }
+    return {'requests': requests, 'errors': errors, 'duration': duration,
+            'throughput': requests / duration, 'routes': routes}
@@ -0,0 +1,68 @@
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache:
+    """A thread safe in-memory cache with LRU eviction and an optional TTL."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[1] is None or item[1] > monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def evict_files(directory, limit):
+    """Delete the oldest files of a cache directory until ``limit`` are left.
+
+    Files whose name starts with a dot, such as ones still being written,
+    are left alone.
+    """
+    entries = [entry for entry in os.scandir(directory)
+               if entry.is_file() and not entry.name.startswith('.')]
+    if len(entries) <= limit:
+        return 0
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    removed = 0
+    for entry in entries[:len(entries) - limit]:
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -1,6 +1,27 @@
+import gzip
+import itertools
+import json
 import os
-from flask import Blueprint
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from flask import Blueprint, current_app
 import click
+import sqlalchemy as sa
+from app import create_app, db, follow_suggestions, post_archive, last_seen_tracker
+from app.models import User, Post, Timeline, PostPartition, followers
+from app.language import detect_texts
+from app.jobs import Worker
+from app.search import get_search_index
+from app.bench import seed as seed_bench, run as run_bench
+from app.follows import apply as apply_follows, read_pairs
+from app.export import DATASETS, FORMATS, batches, parse_checkpoint
+from app.suggestions import FollowGraph
+from app.startup import LAZY_MODULES, by_package, import_times
+from config import Config
 # Import necessary modules for the CLI application
 
 bp = Blueprint('cli', __name__, cli_group=None)
@@ -45,4 +66,512 @@ def compile():
     # Define a new CLI command to compile all languages
     if os.system('pybabel compile -d app/translations'):
         # Run the pybabel compile command to compile the languages
-        raise RuntimeError('compile command failed')
\ No newline at end of file
+        raise RuntimeError('compile command failed')
+
+@bp.cli.group()
+def timeline():
+    """Home timeline commands."""
+
+@timeline.command()
+@click.option('--user', 'username', help='Only rebuild the timeline of this user.')
+def rebuild(username):
+    """Rebuild home timelines from the posts and followers tables."""
+    user_ids = None
+    if username:
+        user = db.session.scalar(sa.select(User).where(User.username == username))
+        if user is None:
+            raise click.ClickException('user {} not found'.format(username))
+        user_ids = [user.id]
+    rows = Timeline.rebuild(user_ids)
+    db.session.commit()
+    click.echo('{} timeline entries written'.format(rows))
+
+
+@bp.cli.group()
+def counters():
+    """Follower, following and post counter commands."""
+
+@counters.command()
+@click.option('--dry-run', is_flag=True, help='Only report how many users drifted.')
+def repair(dry_run):
+    """Recompute user counters and repair the ones that drifted."""
+    users = User.repair_counters(dry_run=dry_run)
+    if not dry_run:
+        db.session.commit()
+    click.echo('{} users with drifted counters{}'.format(users, '' if dry_run else ' repaired'))
+
+
+@bp.cli.group()
+def language():
+    """Post language detection commands."""
+
+@language.command()
+@click.option('--workers', default=os.cpu_count(), help='Number of detection processes.')
+@click.option('--batch-size', default=1000, help='Posts detected per batch.')
+def backfill(workers, batch_size):
+    """Detect the language of posts that do not have one."""
+    total = 0
+    last_id = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            rows = db.session.execute(
+                sa.select(Post.id, Post.body).where(Post.language.is_(None), Post.id > last_id)
+                .order_by(Post.id).limit(batch_size * workers)).all()
+            if not rows:
+                break
+            chunks = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+            results = executor.map(detect_texts, [[row.body for row in chunk] for chunk in chunks])
+            for chunk, languages in zip(chunks, results):
+                db.session.execute(sa.update(Post), [
+                    {'id': row.id, 'language': language}
+                    for row, language in zip(chunk, languages)])
+            db.session.commit()
+            total += len(rows)
+            last_id = rows[-1].id
+            click.echo('{} posts updated'.format(total))
+
+
+@bp.cli.group()
+def avatars():
+    """Avatar commands."""
+
+@avatars.command('backfill')
+@click.option('--batch-size', default=1000, help='Users updated per transaction.')
+def avatars_backfill(batch_size):
+    """Store the gravatar hash of users created before it was kept."""
+    click.echo('{} users updated'.format(User.fill_avatar_hashes(batch_size)))
+
+
+@bp.cli.command()
+@click.option('--concurrency', type=int, help='Number of worker threads.')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+def worker(concurrency, burst):
+    """Run queued background jobs such as sending email."""
+    worker = Worker(current_app._get_current_object(), concurrency)
+    if burst:
+        click.echo('{} jobs run'.format(worker.run_once()))
+        click.echo('{} done jobs deleted'.format(worker.prune()))
+        return
+    worker.start()
+    click.echo('Worker started with {} threads'.format(worker.concurrency))
+    try:
+        while not worker.stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+@bp.cli.group()
+def search():
+    """Post search commands."""
+
+@search.command()
+def reindex():
+    """Rebuild the search index from the posts table."""
+    index = get_search_index()
+    posts = index.reindex()
+    db.session.commit()
+    click.echo('{} posts indexed with the {} backend'.format(posts, index.name))
+
+@search.command('benchmark')
+@click.option('--posts', default=1000000, help='Number of synthetic posts.')
+@click.option('--queries', default=200, help='Number of queries to time.')
+@click.option('--backend', type=click.Choice(['auto', 'fts5', 'inverted']), default='auto')
+def search_benchmark(posts, queries, backend):
+    """Time search queries on a temporary database of synthetic posts."""
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchmarkConfig(Config):
+            TESTING = True
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'benchmark.db')
+            SEARCH_BACKEND = backend
+            LANGUAGE_PRELOAD = False
+
+        with create_app(BenchmarkConfig).app_context():
+            db.create_all()
+            user = User(username='benchmark', email='benchmark@example.com')
+            db.session.add(user)
+            db.session.commit()
+            # word frequencies follow Zipf's law like real text
+            words = ['word{}'.format(i) for i in range(50000)]
+            weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(words))))
+            start = time.perf_counter()
+            for i in range(0, posts, 10000):
+                count = min(10000, posts - i)
+                chosen = random.choices(words, cum_weights=weights, k=count * 12)
+                db.session.execute(sa.insert(Post), [
+                    {'body': ' '.join(chosen[j * 12:(j + 1) * 12]), 'user_id': user.id}
+                    for j in range(count)])
+            db.session.commit()
+            click.echo('{} posts inserted in {:.1f}s'.format(posts, time.perf_counter() - start))
+
+            index = get_search_index()
+            start = time.perf_counter()
+            index.reindex()
+            db.session.commit()
+            click.echo('{} index built in {:.1f}s'.format(index.name, time.perf_counter() - start))
+
+            latencies = []
+            for i in range(queries):
+                text = ' '.join(random.choices(words[:5000], cum_weights=weights[:5000], k=2))
+                start = time.perf_counter()
+                index.search(text)
+                latencies.append((time.perf_counter() - start) * 1000)
+            cuts = statistics.quantiles(latencies, n=100)
+            click.echo('query latency p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms'.format(
+                cuts[49], cuts[94], cuts[98]))
+
+
+@bp.cli.group()
+def bench():
+    """Load testing commands."""
+
+@bench.command('run')
+@click.option('--users', default=1000, help='Number of synthetic users.')
+@click.option('--posts', default=20000, help='Number of synthetic posts.')
+@click.option('--follows', default=20, help='Average number of users each user follows.')
+@click.option('--requests', 'requests_', default=2000, help='Number of requests to send.')
+@click.option('--clients', default=20, help='Number of logged in clients.')
+@click.option('--seed', type=int, help='Random seed, to repeat a run.')
+@click.option('--database', help='Empty database URL to use instead of a temporary SQLite file.')
+@click.option('--output', type=click.Path(dir_okay=False), help='JSON file for the results.')
+def run(users, posts, follows, requests_, clients, seed, database, output):
+    """Seed a database and time the main routes against it."""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchConfig(Config):
+            SQLALCHEMY_DATABASE_URI = database or 'sqlite:///' + os.path.join(tmp, 'bench.db')
+            WTF_CSRF_ENABLED = False
+            RATE_LIMIT_PER_MINUTE = 0
+            LANGUAGE_PRELOAD = False
+            FRAGMENT_CACHE_DIR = os.path.join(tmp, 'fragments')
+            # no log file, error emails or flusher thread outliving the database;
+            # errors still become 500 responses, which the report counts
+            TESTING = True
+            PROPAGATE_EXCEPTIONS = False
+            MAIL_SERVER = None
+            LAST_SEEN_FLUSH_INTERVAL = 0
+
+        app = create_app(BenchConfig)
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            users, edges = seed_bench(users, posts, follows=follows, rng=rng)
+            click.echo('{} users, {} follows and {} posts seeded in {:.1f}s'.format(
+                users, edges, posts, time.perf_counter() - start))
+        report = run_bench(app, requests_, clients=clients, rng=rng)
+        with app.app_context():
+            last_seen_tracker.flush()
+            db.engine.dispose()
+
+    report['config'] = {'users': users, 'posts': posts, 'follows': follows,
+                        'clients': clients, 'seed': seed,
+                        'database': sa.engine.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+                        .get_backend_name()}
+    click.echo('{:.1f} requests/s, {} errors'.format(report['throughput'], report['errors']))
+    for kind, stats in report['routes'].items():
+        click.echo('{:8} n={:<5} p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms queries={:.1f}'.format(
+            kind, stats['requests'], stats['p50'], stats['p95'], stats['p99'], stats['queries']))
+    output = output or 'bench-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.echo('results saved to {}'.format(output))
+
+@bench.command()
+@click.argument('baseline', type=click.File())
+@click.argument('result', type=click.File())
+def compare(baseline, result):
+    """Compare the results of two bench runs."""
+    baseline, result = json.load(baseline), json.load(result)
+    click.echo('throughput {:.1f} -> {:.1f} requests/s'.format(
+        baseline['throughput'], result['throughput']))
+    for kind, stats in result['routes'].items():
+        before = baseline['routes'].get(kind)
+        if before is None:
+            continue
+        click.echo('{:8} p95 {:.1f} -> {:.1f}ms ({:+.0%}) queries {:.1f} -> {:.1f}'.format(
+            kind, before['p95'], stats['p95'], stats['p95'] / before['p95'] - 1,
+            before['queries'], stats['queries']))
+
+
+@bp.cli.group()
+def follows():
+    """Bulk follow graph commands."""
+
+@follows.command('import')
+@click.argument('file', type=click.File(encoding='utf-8'))
+@click.option('--format', 'format_', type=click.Choice(['csv', 'jsonl']),
+              help='File format, guessed from the file name if not given.')
+@click.option('--by', type=click.Choice(['username', 'id']), default='username',
+              help='Whether the file holds usernames or user ids.')
+@click.option('--unfollow', is_flag=True, help='Remove the follows instead of adding them.')
+@click.option('--chunk-size', default=1000, help='Pairs written in each transaction.')
+def import_(file, format_, by, unfollow, chunk_size):
+    """Follow or unfollow the follower,followed pairs of a CSV or JSON lines file."""
+    format_ = format_ or ('csv' if file.name.endswith('.csv') else 'jsonl')
+    try:
+        read, changed = apply_follows(
+            read_pairs(file, format_), unfollow=unfollow, by=by, chunk_size=chunk_size,
+            progress=lambda read, changed: click.echo('{} pairs read, {} changed'.format(read, changed)))
+    except ValueError as e:
+        # the chunks before the bad line are saved, and importing them again changes nothing
+        raise click.BadParameter(str(e), param_hint='FILE')
+    click.echo('{} follows {}'.format(changed, 'removed' if unfollow else 'added'))
+
+@follows.command('benchmark')
+@click.option('--users', default=2000, help='Number of synthetic users.')
+@click.option('--edges', default=20000, help='Number of follows to add.')
+@click.option('--chunk-size', default=1000, help='Pairs written in each transaction.')
+def follows_benchmark(users, edges, chunk_size):
+    """Compare bulk follows with User.follow on a temporary database."""
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchmarkConfig(Config):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'benchmark.db')
+            LANGUAGE_PRELOAD = False
+
+        with create_app(BenchmarkConfig).app_context():
+            db.create_all()
+            db.session.execute(sa.insert(User), [
+                {'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)}
+                for i in range(users)])
+            db.session.commit()
+            ids = db.session.scalars(sa.select(User.id)).all()
+            pairs = set()
+            while len(pairs) < edges:
+                follower, followed = random.sample(ids, 2)
+                pairs.add((follower, followed))
+            pairs = list(pairs)
+            half = len(pairs) // 2
+
+            start = time.perf_counter()
+            for follower, followed in pairs[:half]:
+                db.session.get(User, follower).follow(db.session.get(User, followed))
+                db.session.commit()
+            single = half / (time.perf_counter() - start)
+            start = time.perf_counter()
+            apply_follows(pairs[half:], by='id', chunk_size=chunk_size)
+            bulk = (len(pairs) - half) / (time.perf_counter() - start)
+            click.echo('User.follow: {:.0f} follows/s'.format(single))
+            click.echo('bulk:        {:.0f} follows/s ({:.1f}x)'.format(bulk, bulk / single))
+            db.engine.dispose()
+
+
+@bp.cli.group()
+def suggestions():
+    """Who to follow suggestion commands."""
+
+@suggestions.command('rebuild')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Snapshot file, SUGGESTIONS_SNAPSHOT if not given.')
+def suggestions_rebuild(output):
+    """Build the follow graph from the database and save a snapshot of it."""
+    output = output or current_app.config['SUGGESTIONS_SNAPSHOT']
+    if not output:
+        raise click.UsageError('Set SUGGESTIONS_SNAPSHOT or pass --output.')
+    start = time.perf_counter()
+    graph = follow_suggestions.build()
+    graph.save(output)
+    click.echo('{} follows saved to {} in {:.1f}s'.format(
+        len(graph.targets), output, time.perf_counter() - start))
+
+@suggestions.command('benchmark')
+@click.option('--users', default=100000, help='Number of synthetic users.')
+@click.option('--edges', default=1000000, help='Approximate number of follows.')
+@click.option('--queries', default=1000, help='Number of suggestions to time.')
+@click.option('--budget', default=50.0, help='Highest acceptable p99 latency in ms.')
+@click.option('--seed', type=int, help='Random seed, to repeat a run.')
+def suggestions_benchmark(users, edges, queries, budget, seed):
+    """Time suggestions on a temporary database with a synthetic follow graph."""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        class BenchmarkConfig(Config):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'benchmark.db')
+            SUGGESTIONS_SNAPSHOT = os.path.join(tmp, 'suggestions.bin')
+            LANGUAGE_PRELOAD = False
+
+        with create_app(BenchmarkConfig).app_context():
+            db.create_all()
+            # popularity follows Zipf's law, so a few users have most followers,
+            # and the number of follows of each user is exponentially distributed
+            ids = list(range(1, users + 1))
+            weights = list(itertools.accumulate(1 / i for i in ids))
+            start = time.perf_counter()
+            for first in range(1, users + 1, 1000):
+                rows = []
+                for follower in range(first, min(first + 1000, users + 1)):
+                    degree = int(rng.expovariate(users / edges))
+                    followed = set(rng.choices(ids, cum_weights=weights, k=degree))
+                    followed.discard(follower)
+                    rows.extend({'follower_id': follower, 'followed_id': user}
+                                for user in followed)
+                db.session.execute(sa.insert(followers), rows)
+            db.session.commit()
+            click.echo('follow graph seeded in {:.1f}s'.format(time.perf_counter() - start))
+
+            start = time.perf_counter()
+            graph = follow_suggestions.build()
+            click.echo('{} follows read from the database in {:.1f}s, {:.1f}MB'.format(
+                len(graph.targets), time.perf_counter() - start,
+                (graph.offsets.itemsize * len(graph.offsets) +
+                 graph.targets.itemsize * len(graph.targets)) / 2 ** 20))
+            start = time.perf_counter()
+            graph.save(current_app.config['SUGGESTIONS_SNAPSHOT'])
+            follow_suggestions.refresh()
+            click.echo('snapshot saved and loaded in {:.2f}s'.format(time.perf_counter() - start))
+
+            latencies = []
+            for i in range(queries):
+                user = rng.choice(ids)
+                if i % 10 == 0:
+                    follow_suggestions.record([(user, rng.choice(ids))], True)
+                start = time.perf_counter()
+                follow_suggestions.suggest(user, 10)
+                latencies.append((time.perf_counter() - start) * 1000)
+            cuts = statistics.quantiles(latencies, n=100)
+            click.echo('suggestion latency p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms'.format(
+                cuts[49], cuts[94], cuts[98]))
+            db.engine.dispose()
+    if cuts[98] > budget:
+        raise click.ClickException('p99 latency is over the {:.0f}ms budget'.format(budget))
+
+
+@bp.cli.command('export')
+@click.argument('dataset', type=click.Choice(list(DATASETS)))
+@click.option('--user', 'username', help='Only export the rows of this user.')
+@click.option('--format', 'format_', type=click.Choice(FORMATS), default='jsonl')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Gzip file to write, named after the dataset if not given.')
+@click.option('--after', help='Checkpoint of a previous export, only later rows are exported.')
+@click.option('--resume', is_flag=True, help='Carry on from where an interrupted export stopped.')
+@click.option('--batch-size', default=10000, help='Rows read and written at a time.')
+def export_(dataset, username, format_, output, after, resume, batch_size):
+    """Export posts or follows to a gzip compressed JSON lines or CSV file.
+
+    Every batch is written as a complete gzip member and followed by a
+    checkpoint in OUTPUT.checkpoint, so --resume can cut off a partly
+    written batch and carry on after the last complete one.
+    """
+    output = output or '{}{}.{}.gz'.format(dataset, '-' + username if username else '', format_)
+    state_path = output + '.checkpoint'
+    user_id = None
+    if username:
+        user_id = db.session.scalar(sa.select(User.id).where(User.username == username))
+        if user_id is None:
+            raise click.BadParameter('no user named {}'.format(username), param_hint='--user')
+    offset = 0
+    rows = 0
+    if resume:
+        if not os.path.exists(state_path):
+            raise click.UsageError('There is no checkpoint for {}.'.format(output))
+        with open(state_path) as f:
+            state = json.load(f)
+        if [state['dataset'], state['user'], state['format']] != [dataset, username, format_]:
+            raise click.UsageError('The checkpoint is for an export of {} by {} as {}.'.format(
+                state['dataset'], state['user'] or 'all users', state['format']))
+        after, offset, rows = state['checkpoint'], state['offset'], state['rows']
+    try:
+        after_values = parse_checkpoint(dataset, after) if after else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--after')
+
+    checkpoint = after
+    with open(output, 'r+b' if resume else 'wb') as f:
+        f.truncate(offset)
+        f.seek(offset)
+        for text, count, batch_checkpoint in batches(dataset, format_, user_id=user_id,
+                                                     after=after_values, header=not resume,
+                                                     batch_size=batch_size):
+            with gzip.GzipFile(fileobj=f, mode='wb') as member:
+                member.write(text.encode('utf-8'))
+            f.flush()
+            if batch_checkpoint is None:
+                continue
+            checkpoint = batch_checkpoint
+            rows += count
+            with open(state_path + '.tmp', 'w') as state:
+                json.dump({'dataset': dataset, 'user': username, 'format': format_,
+                           'checkpoint': checkpoint, 'offset': f.tell(), 'rows': rows}, state)
+            os.replace(state_path + '.tmp', state_path)
+            click.echo('{} rows exported, checkpoint {}'.format(rows, checkpoint))
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    click.echo('{} written, export later rows with --after {}'.format(output, checkpoint))
+
+
+@bp.cli.group()
+def archive():
+    """Post retention and archive commands."""
+
+@archive.command('run')
+@click.option('--days', type=int, help='Archive posts older than this, POST_RETENTION_DAYS if not given.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be archived.')
+@click.option('--now', is_flag=True, help='Archive here instead of in background jobs.')
+def archive_run(days, dry_run, now):
+    """Move old posts to the monthly archive tables."""
+    cutoff = post_archive.cutoff(days)
+    if cutoff is None:
+        raise click.UsageError('Set POST_RETENTION_DAYS or pass --days.')
+    plan = post_archive.plan(cutoff)
+    for year, month, count in plan:
+        click.echo('{}-{:02d}  {} posts'.format(int(year), int(month), count))
+    click.echo('{} posts older than {:%Y-%m-%d}'.format(sum(row[2] for row in plan), cutoff))
+    if dry_run or not plan:
+        return
+    if not now:
+        if post_archive.schedule(cutoff) is None:
+            click.echo('an archive job is already queued')
+        else:
+            click.echo('archive job queued, run flask worker to process it')
+        return
+    moved = 0
+    while True:
+        batch = post_archive.archive_batch(cutoff)
+        if not batch:
+            break
+        moved += batch
+        click.echo('{} posts archived'.format(moved))
+
+@archive.command()
+def report():
+    """Show the archive tables and the size of the post table."""
+    for partition in db.session.scalars(sa.select(PostPartition).order_by(PostPartition.month)):
+        click.echo('{}  {:>8} posts  {:%Y-%m-%d} to {:%Y-%m-%d}  {}'.format(
+            partition.month, partition.post_count, partition.oldest, partition.newest,
+            partition.table_name))
+    count, oldest = db.session.execute(
+        sa.select(sa.func.count(), sa.func.min(Post.timestamp))).one()
+    click.echo('post table  {} posts{}'.format(
+        count, ', oldest {:%Y-%m-%d}'.format(oldest) if oldest else ''))
+    if db.engine.dialect.name == 'sqlite':
+        connection = db.session.connection()
+        page_size = connection.exec_driver_sql('PRAGMA page_size').scalar()
+        pages = connection.exec_driver_sql('PRAGMA page_count').scalar()
+        free = connection.exec_driver_sql('PRAGMA freelist_count').scalar()
+        click.echo('database file {:.1f}MB, {:.1f}MB free{}'.format(
+            pages * page_size / 2 ** 20, free * page_size / 2 ** 20,
+            ', run flask archive compact to give it back' if free else ''))
+
+@archive.command()
+def compact():
+    """Give the space freed by archived posts back to the operating system."""
+    db.session.remove()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if db.engine.dialect.name in ('sqlite', 'postgresql'):
+            connection.exec_driver_sql('VACUUM')
+        else:
+            connection.exec_driver_sql('OPTIMIZE TABLE post, timeline')
+    click.echo('database compacted')
+
+
+@bp.cli.command()
+@click.option('--top', default=20, help='Number of packages to show.')
+def startup(top):
+    """Report the import time of each package when the app is loaded."""
+    times = import_times()
+    total = sum(own for _, own, _ in times)
+    click.echo('microblog imported in {:.0f}ms'.format(total / 1000))
+    for package, own in by_package(times)[:top]:
+        click.echo('{:>8.1f}ms  {:5.1f}%  {}'.format(own / 1000, own / total * 100, package))
+    loaded = {module.split('.')[0] for module, _, _ in times}
+    for package in LAZY_MODULES:
+        if package in loaded:
+            click.echo('warning: {} is imported at startup'.format(package))
@@ -0,0 +1,67 @@
+from time import time
+from flask import current_app, has_request_context, session
+import sqlalchemy as sa
+
+# session key holding the time until which this user reads from the primary
+PRIMARY_UNTIL_KEY = '_read_primary_until'
+
+
+def engine_options(config):
+    # pool settings only apply to server databases, SQLite is tuned with pragmas
+    url = sa.engine.make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite':
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}}
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+    }
+
+
+def configure(app):
+    """Fill in the engine options and the replica bind before db.init_app()."""
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    if app.config['DATABASE_REPLICA_URL']:
+        app.config.setdefault('SQLALCHEMY_BINDS', {})
+        app.config['SQLALCHEMY_BINDS']['replica'] = app.config['DATABASE_REPLICA_URL']
+
+
+def init_engines(app, db):
+    """Install the SQLite pragmas after db.init_app() has made the engines."""
+    # the replica is a copy of the primary, so create_all() must not treat it
+    # as a database with tables of its own
+    db.metadatas.pop('replica', None)
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                sa.event.listen(engine, 'connect', _sqlite_pragmas(app.config,
+                                                                   engine.url.database))
+
+
+def _sqlite_pragmas(config, database):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers run while a write is in progress, not possible in memory
+        if database and database != ':memory:' and config['SQLITE_WAL']:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(config['SQLITE_BUSY_TIMEOUT']))
+        cursor.execute('PRAGMA mmap_size={:d}'.format(config['SQLITE_MMAP_SIZE']))
+        cursor.close()
+    return on_connect
+
+
+def read_primary_for_a_while():
+    # after a write this user reads from the primary until the replica catches up
+    session[PRIMARY_UNTIL_KEY] = time() + current_app.config['DATABASE_REPLICA_LAG']
+
+
+def replica_bind():
+    """bind_arguments for read-only listing queries, or None to use the primary."""
+    from app import db
+    if 'replica' not in db.engines:
+        return None
+    if has_request_context() and session.get(PRIMARY_UNTIL_KEY, 0) > time():
+        return None
+    return {'bind': db.engines['replica']}
@@ -1,22 +1,47 @@
-from threading import Thread  # Import Thread for asynchronous email sending
-from flask import current_app  # Import current_app to access Flask application context
+import smtplib
+import threading
 from flask_mail import Message  # Import Message for email creation
 from app import mail  # Import mail to send the email
-from threading import Thread
-from flask import current_app
-from flask_mail import Message
-from app import mail
+from app.jobs import enqueue, job, thread_cleanup
 
+# each worker thread keeps its SMTP connection open between messages
+_local = threading.local()
 
-def send_async_email(app, msg):
-    # Send email asynchronously within application context
-    with app.app_context():
-        mail.send(msg)
 
+def get_connection():
+    if getattr(_local, 'connection', None) is None:
+        _local.connection = mail.connect().__enter__()
+    return _local.connection
 
-def send_email(subject, sender, recipients, text_body, html_body):
-    # Create and send an email using a separate thread for asynchronous delivery
+
+@thread_cleanup
+def close_connection():
+    connection = getattr(_local, 'connection', None)
+    _local.connection = None
+    if connection is not None:
+        try:
+            connection.__exit__(None, None, None)
+        except smtplib.SMTPException:
+            pass
+
+
+@job('send_email')
+def send_queued_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+    try:
+        get_connection().send(msg)
+    except smtplib.SMTPServerDisconnected:
+        # the server closed the idle connection, reconnect once
+        _local.connection = None
+        get_connection().send(msg)
+    except Exception:
+        close_connection()
+        raise
+
+
+def send_email(subject, sender, recipients, text_body, html_body):
+    # Queue the email, it is sent by the job workers (see 'flask worker')
+    enqueue('send_email', subject=subject, sender=sender, recipients=recipients,
+            text_body=text_body, html_body=html_body)
@@ -0,0 +1,44 @@
+import hashlib
+from functools import wraps
+from time import time
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+from app import fragment_cache
+
+
+def _csrf_bucket():
+    # a cached page must not outlive the CSRF tokens in its forms
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return int(time() // (limit / 2)) if limit else None
+
+
+def etag(validator):
+    """Answer conditional GETs of a logged in page with 304 Not Modified.
+
+    ``validator`` is called with the view arguments and returns a cheap
+    summary of the data the page shows. It is combined with the viewer, the
+    locale and the template version into a weak ETag, so a request whose
+    If-None-Match matches is answered before the view runs its queries.
+    Pages with pending flashed messages are never cached.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return f(*args, **kwargs)
+            parts = [current_user.get_id(), getattr(current_user, 'username', None), g.locale,
+                     fragment_cache.template_version, _csrf_bucket(), request.full_path,
+                     validator(*args, **kwargs)]
+            tag = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains_weak(tag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(tag, weak=True)
+            # the page depends on who is logged in and their language
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.update(('Cookie', 'Accept-Language'))
+            return response
+        return wrapped
+    return decorator
@@ -0,0 +1,207 @@
+import json
+import queue
+import threading
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+import sqlalchemy as sa
+
+
+class Subscriber:
+    """One open /events stream, with a bounded queue of events to send."""
+
+    def __init__(self, user_id, authors, maxsize):
+        self.user_id = user_id
+        self.authors = authors
+        self.queue = queue.Queue(maxsize)
+        self.dropped = False
+
+
+class LocalBroker:
+    """Hands published events straight to the subscribers of this process.
+
+    Only correct when the app runs in a single process.
+    """
+
+    def __init__(self, app, deliver):
+        self.deliver = deliver
+
+    def publish(self, event):
+        self.deliver(event)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class DatabaseBroker:
+    """Passes events between processes through the event table.
+
+    Published events are inserted as rows, and publishing deletes the rows
+    older than EVENTS_RETENTION seconds about once a minute. Every process
+    with subscribers runs one thread that reads the new rows every
+    EVENTS_POLL_INTERVAL seconds, so the database is polled once per
+    process rather than once per client, and not at all while nobody is
+    listening.
+    """
+
+    def __init__(self, app, deliver):
+        self.app = app
+        self.deliver = deliver
+        self.last_id = None
+        self.pruned_at = None
+        self._stop = None
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        from app import db
+        from app.models import Event
+        db.session.add(Event(payload=json.dumps(event)))
+        if self.pruned_at is None or monotonic() - self.pruned_at > 60:
+            self.pruned_at = monotonic()
+            self.prune()
+        db.session.commit()
+
+    def latest_id(self):
+        from app import db
+        from app.models import Event
+        return db.session.scalar(sa.select(sa.func.max(Event.id))) or 0
+
+    def poll(self):
+        """Deliver the events published since the last poll, returns how many."""
+        from app import db
+        from app.models import Event
+        if self.last_id is None:
+            self.last_id = self.latest_id()
+        rows = db.session.execute(sa.select(Event.id, Event.payload).where(
+            Event.id > self.last_id).order_by(Event.id)).all()
+        for event_id, payload in rows:
+            self.deliver(json.loads(payload))
+            self.last_id = event_id
+        return len(rows)
+
+    def prune(self):
+        from app import db
+        from app.models import Event
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.app.config['EVENTS_RETENTION'])
+        db.session.execute(sa.delete(Event).where(Event.timestamp < cutoff))
+
+    def start(self):
+        with self._lock:
+            if self._stop is None:
+                # events published while nobody listened are not news to anyone,
+                # those published from the first subscription on are
+                self.last_id = self.latest_id()
+                self._stop = threading.Event()
+                threading.Thread(target=self._run, args=(self._stop,), daemon=True,
+                                 name='events-poller').start()
+
+    def stop(self):
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+                self._stop = None
+
+    def _run(self, stop):
+        from app import db
+        while not stop.wait(self.app.config['EVENTS_POLL_INTERVAL']):
+            try:
+                with self.app.app_context():
+                    self.poll()
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception('Failed to poll for events')
+
+
+BROKERS = {'local': LocalBroker, 'database': DatabaseBroker}
+
+
+class EventStream:
+    """Pushes new post notifications to the followers of the author.
+
+    Each open stream gets a queue of EVENTS_QUEUE_SIZE events. A subscriber
+    whose queue is full is dropped instead of slowing down the publisher;
+    its browser reconnects and starts counting again. EVENTS_BROKER picks
+    how events reach the other processes of the app.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.broker = None
+        self.subscribers = {}
+        self.streams = set()
+        self.dropped = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.broker is not None:
+            self.broker.stop()
+        self.app = app
+        self.broker = BROKERS[app.config['EVENTS_BROKER']](app, self.deliver)
+        self.subscribers = {}
+        self.streams = set()
+        self.dropped = 0
+
+    def publish_post(self, post):
+        self.broker.publish({'type': 'post', 'author_id': post.user_id, 'post_id': post.id})
+
+    def subscribe(self, user_id, authors):
+        """Start receiving the posts of ``authors``, or None when there are too many streams."""
+        subscriber = Subscriber(user_id, set(authors), self.app.config['EVENTS_QUEUE_SIZE'])
+        with self._lock:
+            if len(self.streams) >= self.app.config['EVENTS_MAX_SUBSCRIBERS']:
+                return None
+            self.streams.add(subscriber)
+            for author in subscriber.authors:
+                self.subscribers.setdefault(author, set()).add(subscriber)
+        self.broker.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.streams.discard(subscriber)
+            for author in subscriber.authors:
+                subscribers = self.subscribers.get(author)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.subscribers[author]
+            idle = not self.streams
+        if idle:
+            self.broker.stop()
+
+    def deliver(self, event):
+        with self._lock:
+            subscribers = list(self.subscribers.get(event['author_id'], ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                subscriber.dropped = True
+                self.dropped += 1
+                self.unsubscribe(subscriber)
+
+    def stream(self, subscriber):
+        """Yield the server-sent events for a subscriber until it goes away."""
+        keepalive = self.app.config['EVENTS_KEEPALIVE']
+        post_ids = []
+        try:
+            yield 'retry: 5000\n\n'
+            while not subscriber.dropped:
+                try:
+                    event = subscriber.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    # lets the server notice closed connections
+                    yield ': keepalive\n\n'
+                    continue
+                post_ids.append(event['post_id'])
+                yield 'event: posts\ndata: {}\n\n'.format(json.dumps(
+                    {'count': len(post_ids), 'ids': post_ids[-100:]}))
+        finally:
+            self.unsubscribe(subscriber)
+
+    def metrics(self):
+        return {'subscribers': len(self.streams), 'dropped': self.dropped}
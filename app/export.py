@@ -0,0 +1,110 @@
+import csv
+import heapq
+import io
+import json
+from datetime import datetime
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import db, post_archive
+from app.models import User, Post, followers
+from app.pagination import _seek
+
+FORMATS = ('jsonl', 'csv')
+
+
+def _posts(user_id):
+    # the post table and every archive table, merged when they are read
+    sources = []
+    for table in [Post.__table__] + [post_archive.table(month)
+                                     for month, _, _ in post_archive.partitions()]:
+        query = sa.select(table.c.id, table.c.timestamp, User.username.label('author'),
+                          table.c.body, table.c.language).join(User, User.id == table.c.user_id)
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        sources.append((query, (table.c.timestamp, table.c.id)))
+    return sources
+
+
+def _follows(user_id):
+    Follower = so.aliased(User)
+    Followed = so.aliased(User)
+    query = sa.select(followers.c.follower_id, Follower.username.label('follower'),
+                      followers.c.followed_id, Followed.username.label('followed')) \
+        .join(Follower, Follower.id == followers.c.follower_id) \
+        .join(Followed, Followed.id == followers.c.followed_id)
+    if user_id is not None:
+        query = query.where(sa.or_(followers.c.follower_id == user_id,
+                                   followers.c.followed_id == user_id))
+    return [(query, (followers.c.follower_id, followers.c.followed_id))]
+
+
+# dataset -> function returning (query, columns) for each table the dataset is
+# read from, where columns are the sort key the rows are exported in order of
+DATASETS = {'posts': _posts, 'follows': _follows}
+
+
+def parse_checkpoint(dataset, text):
+    """Turn a checkpoint such as '2024-01-31T10:00:00,42' into sort key values.
+
+    Raises ValueError when the text does not fit the dataset.
+    """
+    _, columns = DATASETS[dataset](None)[0]
+    values = text.split(',')
+    if len(values) != len(columns):
+        raise ValueError('expected {} comma separated values'.format(len(columns)))
+    return [datetime.fromisoformat(value) if isinstance(column.type, sa.DateTime)
+            else int(value) for column, value in zip(columns, values)]
+
+
+def rows(dataset, user_id=None, after=None, batch_size=1000):
+    """Yield the rows of a dataset as dicts, oldest first.
+
+    Rows are read through a server side cursor ``batch_size`` at a time, so
+    memory does not grow with the number of rows. When a dataset is spread
+    over several tables, such as archived posts, each one is read in order
+    and the rows are merged. ``after`` is a list of sort key values from
+    parse_checkpoint; only later rows are returned.
+    """
+    results = []
+    for query, columns in DATASETS[dataset](user_id):
+        if after is not None:
+            query = query.where(_seek(columns, after, False))
+        query = query.order_by(*columns).execution_options(yield_per=batch_size)
+        results.append(db.session.execute(query))
+    keys = [column.key for column in columns]
+    for row in heapq.merge(*results, key=lambda row: [getattr(row, key) for key in keys]):
+        yield {key: value.isoformat() if isinstance(value, datetime) else value
+               for key, value in row._mapping.items()}
+
+
+def batches(dataset, format, user_id=None, after=None, header=True, batch_size=1000):
+    """Yield (text, rows, checkpoint) for every ``batch_size`` exported rows.
+
+    The checkpoint of a batch is the sort key of its last row, to pass back
+    as ``after`` to carry on from there. With CSV and ``header`` the header
+    row comes first, in a batch of its own with no rows and no checkpoint.
+    """
+    query, columns = DATASETS[dataset](None)[0]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=query.selected_columns.keys())
+    if format == 'csv' and header:
+        writer.writeheader()
+        yield buffer.getvalue(), 0, None
+        buffer.seek(0)
+        buffer.truncate()
+    count = 0
+    checkpoint = None
+    for row in rows(dataset, user_id=user_id, after=after, batch_size=batch_size):
+        if format == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row) + '\n')
+        count += 1
+        checkpoint = ','.join(str(row[column.key]) for column in columns)
+        if count == batch_size:
+            yield buffer.getvalue(), count, checkpoint
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    if count:
+        yield buffer.getvalue(), count, checkpoint
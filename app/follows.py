@@ -0,0 +1,143 @@
+import csv
+import json
+from itertools import islice
+import sqlalchemy as sa
+from flask import current_app
+from app import db, identity_cache, follow_suggestions
+from app.models import User, Post, Timeline, followers
+
+
+def read_pairs(stream, format):
+    """Yield (follower, followed) pairs from a CSV or JSON lines text stream.
+
+    CSV rows hold the two values, with an optional follower,followed header.
+    JSON lines are [follower, followed] arrays or objects with those keys.
+    Raises ValueError, naming the line, for rows that are neither.
+    """
+    if format == 'csv':
+        for number, row in enumerate(csv.reader(stream), 1):
+            if not row:
+                continue
+            if len(row) < 2:
+                raise ValueError('line {}: expected follower,followed'.format(number))
+            if [value.strip() for value in row[:2]] != ['follower', 'followed']:
+                yield row[0].strip(), row[1].strip()
+        return
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            pair = (item['follower'], item['followed']) if isinstance(item, dict) else tuple(item)
+        except (ValueError, KeyError, TypeError):
+            pair = None
+        if pair is None or len(pair) != 2:
+            raise ValueError('line {}: expected [follower, followed] or an object with '
+                             'those keys'.format(number))
+        yield pair
+
+
+def _insert_ignore(dialect):
+    # INSERT that skips rows already in the table, in the database's own syntax
+    if dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(followers).on_conflict_do_nothing()
+    if dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(followers).on_conflict_do_nothing()
+    return sa.insert(followers).prefix_with('IGNORE')
+
+
+def _user_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _resolve(chunk, by):
+    # turns username pairs into id pairs, dropping unknown users and self follows
+    if by == 'id':
+        pairs = {(_user_id(a), _user_id(b)) for a, b in chunk}
+        known = set(db.session.scalars(sa.select(User.id).where(
+            User.id.in_({user_id for pair in pairs for user_id in pair}))))
+    else:
+        ids = dict(db.session.execute(sa.select(User.username, User.id).where(
+            User.username.in_({str(name) for pair in chunk for name in pair}))).all())
+        pairs = {(ids.get(str(a)), ids.get(str(b))) for a, b in chunk}
+        known = set(ids.values())
+    return {(a, b) for a, b in pairs if a in known and b in known and a != b}
+
+
+def _backfill(edges):
+    # Timeline.backfill for many follows: the recent posts of each newly
+    # followed user, at most TIMELINE_BACKFILL_LIMIT of them
+    ranked = sa.select(
+        Post.id, Post.user_id, Post.timestamp,
+        sa.func.row_number().over(partition_by=Post.user_id,
+                                  order_by=(Post.timestamp.desc(), Post.id.desc())).label('rank'),
+    ).where(Post.user_id.in_({b for _, b in edges}), Timeline.fans_out(Post.user_id)).subquery()
+    posts = sa.select(followers.c.follower_id, ranked.c.id, ranked.c.timestamp) \
+        .join(ranked, ranked.c.user_id == followers.c.followed_id).where(
+            sa.tuple_(followers.c.follower_id, followers.c.followed_id).in_(edges),
+            ranked.c.rank <= current_app.config['TIMELINE_BACKFILL_LIMIT'],
+            ~sa.select(Timeline.post_id).where(
+                Timeline.user_id == followers.c.follower_id,
+                Timeline.post_id == ranked.c.id).exists())
+    db.session.execute(sa.insert(Timeline).from_select(
+        ['user_id', 'post_id', 'timestamp'], posts))
+
+
+def _prune(edges):
+    # Timeline.prune for many unfollows: only the posts of the unfollowed users go
+    db.session.execute(sa.delete(Timeline).where(
+        Timeline.user_id.in_({a for a, _ in edges}),
+        sa.select(Post.id).where(
+            Post.id == Timeline.post_id,
+            sa.tuple_(Timeline.user_id, Post.user_id).in_(edges)).exists()))
+
+
+def apply(pairs, unfollow=False, by='username', chunk_size=1000, progress=None):
+    """Follow or unfollow many (follower, followed) pairs with set based writes.
+
+    Pairs are applied in chunks of ``chunk_size``, each in its own
+    transaction: one INSERT ... ON CONFLICT DO NOTHING or DELETE ... WHERE
+    IN for the edges that change, then the counters of the users in the
+    chunk are recomputed and their timelines get the new authors' recent
+    posts or lose the unfollowed authors' posts. ``progress`` is called
+    after every chunk with the pairs read and the edges changed so far.
+    Returns the same two numbers; pairs with unknown users or ids that are
+    not numbers, and pairs that change nothing, are skipped.
+    """
+    pairs = iter(pairs)
+    read = changed = 0
+    while True:
+        chunk = list(islice(pairs, chunk_size))
+        if not chunk:
+            break
+        read += len(chunk)
+        edges = _resolve(chunk, by)
+        if edges:
+            edge = sa.tuple_(followers.c.follower_id, followers.c.followed_id)
+            existing = set(db.session.execute(
+                sa.select(followers.c.follower_id, followers.c.followed_id).where(
+                    edge.in_(edges))).all())
+            edges = existing & edges if unfollow else edges - existing
+        if edges:
+            if unfollow:
+                result = db.session.execute(sa.delete(followers).where(edge.in_(edges)))
+                _prune(edges)
+            else:
+                result = db.session.execute(_insert_ignore(db.engine.dialect), [
+                    {'follower_id': a, 'followed_id': b} for a, b in edges])
+                _backfill(edges)
+            changed += result.rowcount
+            user_ids = {user_id for edge in edges for user_id in edge}
+            User.repair_counters(user_ids=user_ids)
+        db.session.commit()
+        if edges:
+            identity_cache.invalidate_ids(*user_ids)
+            follow_suggestions.record(edges, not unfollow)
+        if progress is not None:
+            progress(read, changed)
+    return read, changed
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import tempfile
+from flask import g, render_template
+from markupsafe import Markup
+from app.cache import LRUCache, evict_files
+
+
+class FileFragmentStore:
+    """Fragments stored as files in a directory shared by all workers.
+
+    Every ``limit // 10`` writes the oldest files are deleted until at most
+    ``limit`` are left, which also clears out fragments of edited posts and
+    old template versions.
+    """
+
+    def __init__(self, directory, limit=100000):
+        self.directory = directory
+        self.limit = limit
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, html):
+        # written to a temporary file first so readers never see half a fragment
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(html)
+        os.replace(tmp, self._path(key))
+        self.writes += 1
+        if self.writes % max(self.limit // 10, 1) == 0:
+            evict_files(self.directory, self.limit)
+
+
+class FragmentCache:
+    """Caches the rendered HTML of _post.html for each post.
+
+    Fragments are keyed on the post id, the locale, a hash of the template
+    source and the post fields the template shows that can still change.
+    They are kept in a bounded LRU cache, and with
+    FRAGMENT_CACHE_BACKEND = 'filesystem' also in FRAGMENT_CACHE_DIR so
+    that other workers can reuse them.
+    """
+
+    def __init__(self, app=None):
+        self.local = None
+        self.shared = None
+        self.enabled = False
+        self.template_version = None
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['FRAGMENT_CACHE_BACKEND']
+        self.enabled = backend != 'none'
+        self.local = LRUCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'])
+        self.shared = FileFragmentStore(app.config['FRAGMENT_CACHE_DIR'],
+                                        app.config['FRAGMENT_CACHE_DIR_LIMIT']) \
+            if backend == 'filesystem' else None
+        source = app.jinja_env.loader.get_source(app.jinja_env, '_post.html')[0]
+        self.template_version = hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]
+        self.hits = 0
+        self.misses = 0
+        app.jinja_env.globals['render_post'] = self.render_post
+
+    def key(self, post):
+        return 'post:{}:{}:{}:{}:{}'.format(post.id, g.locale, self.template_version,
+                                           post.author.username, post.language)
+
+    def render_post(self, post):
+        if not self.enabled:
+            return Markup(render_template('_post.html', post=post))
+        key = self.key(post)
+        html = self.local.get(key)
+        if html is None and self.shared is not None:
+            html = self.shared.get(key)
+            if html is not None:
+                self.local.set(key, html)
+        if html is not None:
+            self.hits += 1
+            return Markup(html)
+        self.misses += 1
+        html = render_template('_post.html', post=post)
+        self.local.set(key, html)
+        if self.shared is not None:
+            self.shared.set(key, html)
+        return Markup(html)
+
+    def metrics(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.local)}
@@ -0,0 +1,90 @@
+from datetime import datetime
+from time import time
+from flask import has_request_context, request, session
+from flask_login import user_logged_out
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app.cache import LRUCache
+
+SESSION_KEY = '_identity'
+# never cached, and loaded from the database on first access
+EXCLUDED = {'password_hash'}
+
+
+class IdentityCache:
+    """Loads the logged in user for Flask-Login without a database round trip.
+
+    The column values of recently loaded users are kept for
+    IDENTITY_CACHE_TTL seconds and attached to the session with
+    merge(load=False). With LOGIN_SESSION_SNAPSHOT the values are also kept
+    in the signed session cookie and used for GET and HEAD requests.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.cache = LRUCache(maxsize=app.config['IDENTITY_CACHE_SIZE'],
+                              ttl=app.config['IDENTITY_CACHE_TTL'])
+        user_logged_out.connect(self._logged_out, app)
+
+    @staticmethod
+    def snapshot(user):
+        from app.models import User
+        return {attr.key: getattr(user, attr.key) for attr in sa.inspect(User).column_attrs
+                if attr.key not in EXCLUDED}
+
+    def load(self, user_id):
+        from app import db
+        from app.models import User
+        values = self.cache.get(user_id)
+        if values is None:
+            values = self._from_session(user_id)
+        if values is not None:
+            user = User(**values)
+            so.make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+        user = db.session.get(User, user_id)
+        if user is not None:
+            values = self.snapshot(user)
+            self.cache.set(user_id, values)
+            if self.app.config['LOGIN_SESSION_SNAPSHOT']:
+                session[SESSION_KEY] = dict(
+                    {k: v.isoformat() if isinstance(v, datetime) else v
+                     for k, v in values.items()}, _at=time())
+        return user
+
+    def invalidate(self, *users):
+        self.invalidate_ids(*[user.id for user in users])
+
+    def invalidate_ids(self, *user_ids):
+        for user_id in user_ids:
+            self.cache.delete(user_id)
+        stored = session.get(SESSION_KEY) if has_request_context() else None
+        if stored and stored['id'] in user_ids:
+            session.pop(SESSION_KEY)
+
+    def metrics(self):
+        return {'hits': self.cache.hits, 'misses': self.cache.misses, 'size': len(self.cache)}
+
+    def _from_session(self, user_id):
+        # the signed snapshot is only trusted for requests that do not write
+        if not self.app.config['LOGIN_SESSION_SNAPSHOT'] or \
+                request.method not in ('GET', 'HEAD'):
+            return None
+        stored = session.get(SESSION_KEY)
+        if not stored or stored['id'] != user_id or \
+                stored['_at'] + self.app.config['IDENTITY_CACHE_TTL'] < time():
+            return None
+        from app.models import User
+        dates = {attr.key for attr in sa.inspect(User).column_attrs
+                 if isinstance(attr.columns[0].type, sa.DateTime)}
+        return {k: datetime.fromisoformat(v) if k in dates and v else v
+                for k, v in stored.items() if k != '_at'}
+
+    def _logged_out(self, app, user):
+        session.pop(SESSION_KEY, None)
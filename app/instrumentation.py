@@ -0,0 +1,197 @@
+import cProfile
+import json
+import os
+import random
+import threading
+from collections import defaultdict
+from time import perf_counter, time
+from flask import Response, g, has_app_context, request, request_finished, \
+    request_started, before_render_template, template_rendered
+import sqlalchemy as sa
+
+# upper bounds in seconds of the request duration histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_depth = 0
+        self.render_started = None
+        self.slow_queries = []
+        self.profile = None
+
+
+class Instrumentation:
+    """Opt-in per-request SQL, template and timing instrumentation.
+
+    With INSTRUMENTATION set, every request records its query count, time
+    spent in the database and rendering templates, and the queries slower
+    than SLOW_QUERY_THRESHOLD milliseconds. These are sent back in a
+    Server-Timing header, logged as one JSON line, and summed per endpoint
+    for the Prometheus text served at /metrics. PROFILE_SAMPLE_RATE of the
+    requests also run under cProfile, with the stats saved to PROFILE_DIR.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.totals = defaultdict(float)
+        self.histogram = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['INSTRUMENTATION']
+        self.requests.clear()
+        self.totals.clear()
+        self.histogram.clear()
+        if not self.enabled:
+            return
+        from app import db
+        with app.app_context():
+            for engine in db.engines.values():
+                sa.event.listen(engine, 'before_cursor_execute', self._before_execute)
+                sa.event.listen(engine, 'after_cursor_execute', self._after_execute)
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._rendered, app)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    @staticmethod
+    def _stats():
+        return g.get('_request_stats') if has_app_context() else None
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info['query_started'].pop()
+        stats = self._stats()
+        if stats is None:
+            return
+        stats.queries += 1
+        stats.db_time += elapsed
+        if elapsed * 1000 >= self.app.config['SLOW_QUERY_THRESHOLD']:
+            stats.slow_queries.append({'statement': statement, 'parameters': repr(parameters),
+                                       'ms': round(elapsed * 1000, 2)})
+
+    def _request_started(self, app, **extra):
+        stats = g._request_stats = RequestStats()
+        if random.random() < app.config['PROFILE_SAMPLE_RATE']:
+            stats.profile = cProfile.Profile()
+            try:
+                stats.profile.enable()
+            except ValueError:
+                # another profiler is already running in this thread
+                stats.profile = None
+
+    def _before_render(self, app, template, context, **extra):
+        stats = self._stats()
+        if stats is not None:
+            # templates rendered inside another one are already in its time
+            if stats.render_depth == 0:
+                stats.render_started = perf_counter()
+            stats.render_depth += 1
+
+    def _rendered(self, app, template, context, **extra):
+        stats = self._stats()
+        if stats is not None and stats.render_depth:
+            stats.render_depth -= 1
+            if stats.render_depth == 0:
+                stats.render_time += perf_counter() - stats.render_started
+
+    def _request_finished(self, app, response, **extra):
+        stats = g.pop('_request_stats', None)
+        if stats is None:
+            return
+        duration = perf_counter() - stats.started
+        if stats.profile is not None:
+            stats.profile.disable()
+            self._save_profile(stats.profile)
+        response.headers['Server-Timing'] = \
+            'db;dur={:.1f};desc="{} queries", render;dur={:.1f}, total;dur={:.1f}'.format(
+                stats.db_time * 1000, stats.queries, stats.render_time * 1000, duration * 1000)
+        endpoint = request.endpoint or 'none'
+        with self._lock:
+            self.requests[(endpoint, request.method, response.status_code)] += 1
+            self.totals[('db_queries', endpoint)] += stats.queries
+            self.totals[('db_seconds', endpoint)] += stats.db_time
+            self.totals[('render_seconds', endpoint)] += stats.render_time
+            self.totals[('slow_queries', endpoint)] += len(stats.slow_queries)
+            self.totals[('duration_seconds', endpoint)] += duration
+            counts = self.histogram[endpoint]
+            counts[next((i for i, bound in enumerate(BUCKETS) if duration <= bound),
+                        len(BUCKETS))] += 1
+        app.logger.info(json.dumps({
+            'event': 'request', 'method': request.method, 'path': request.path,
+            'endpoint': endpoint, 'status': response.status_code,
+            'ms': round(duration * 1000, 2), 'db_queries': stats.queries,
+            'db_ms': round(stats.db_time * 1000, 2),
+            'render_ms': round(stats.render_time * 1000, 2),
+            'slow_queries': stats.slow_queries}))
+
+    def _save_profile(self, profile):
+        directory = self.app.config['PROFILE_DIR']
+        os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(os.path.join(directory, '{}-{:.6f}-{}.prof'.format(
+            request.endpoint or 'none', time(), os.getpid())))
+
+    def metrics(self):
+        """The collected metrics in the Prometheus text format."""
+        from app import fragment_cache, identity_cache, last_seen_tracker, follow_suggestions, \
+            event_stream
+        lines = []
+
+        def header(name, kind, help):
+            lines.append('# HELP microblog_{} {}'.format(name, help))
+            lines.append('# TYPE microblog_{} {}'.format(name, kind))
+
+        def sample(name, value, **labels):
+            label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels.items())
+            lines.append('microblog_{}{} {}'.format(
+                name, '{' + label_text + '}' if label_text else '', value))
+
+        with self._lock:
+            header('http_requests_total', 'counter', 'Requests served.')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                sample('http_requests_total', count, endpoint=endpoint, method=method,
+                       status=status)
+            header('http_request_duration_seconds', 'histogram', 'Request duration.')
+            for endpoint, counts in sorted(self.histogram.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    sample('http_request_duration_seconds_bucket', cumulative,
+                           endpoint=endpoint, le=bound)
+                sample('http_request_duration_seconds_sum',
+                       self.totals[('duration_seconds', endpoint)], endpoint=endpoint)
+                sample('http_request_duration_seconds_count', cumulative, endpoint=endpoint)
+            for name, help in (('db_queries', 'SQL statements executed.'),
+                               ('db_seconds', 'Time spent in the database.'),
+                               ('render_seconds', 'Time spent rendering templates.'),
+                               ('slow_queries', 'Queries slower than SLOW_QUERY_THRESHOLD.')):
+                header(name + '_total', 'counter', help)
+                for (key, endpoint), value in sorted(self.totals.items()):
+                    if key == name:
+                        sample(name + '_total', value, endpoint=endpoint)
+        for prefix, values in (('fragment_cache', fragment_cache.metrics()),
+                               ('identity_cache', identity_cache.metrics()),
+                               ('last_seen', last_seen_tracker.metrics()),
+                               ('suggestions', follow_suggestions.metrics()),
+                               ('events', event_stream.metrics())):
+            for key, value in values.items():
+                name = '{}_{}'.format(prefix, key)
+                header(name, 'gauge', name.replace('_', ' ').capitalize() + '.')
+                sample(name, value)
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        return Response(self.metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,145 @@
+import json
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+import sqlalchemy as sa
+from app import db
+from app.models import Job
+
+# job kind -> function called with the decoded payload
+handlers = {}
+# functions called when a worker thread exits, to release per-thread resources
+cleanups = []
+
+
+def job(kind):
+    """Register a function as the handler for a kind of job."""
+    def decorator(f):
+        handlers[kind] = f
+        return f
+    return decorator
+
+
+def thread_cleanup(f):
+    cleanups.append(f)
+    return f
+
+
+def enqueue(kind, **payload):
+    queued = Job(kind=kind, payload=json.dumps(payload))
+    db.session.add(queued)
+    db.session.commit()
+    return queued
+
+
+class Worker:
+    """Runs queued jobs from the database with a fixed pool of threads.
+
+    A claimed job is leased for JOB_LEASE seconds, so jobs held by a worker
+    that died are picked up again. Failed jobs are retried with exponential
+    backoff until JOB_MAX_ATTEMPTS is reached. Done jobs lose their payload
+    and are deleted JOB_RETENTION seconds later by idle workers.
+    """
+
+    def __init__(self, app, concurrency=None):
+        self.app = app
+        self.concurrency = concurrency or app.config['JOB_WORKERS']
+        self.stopping = threading.Event()
+        self.threads = []
+        self.pruned_at = None
+
+    def claim(self):
+        now = datetime.now(timezone.utc)
+        ready = sa.or_(
+            sa.and_(Job.status == 'queued', Job.run_at <= now),
+            sa.and_(Job.status == 'running', Job.run_at <= now))
+        candidates = db.session.scalars(
+            sa.select(Job.id).where(ready).order_by(Job.run_at).limit(self.concurrency)).all()
+        for job_id in candidates:
+            # only one worker can win the update for a given job
+            claimed = db.session.execute(
+                sa.update(Job).where(Job.id == job_id, ready).values(
+                    status='running', attempts=Job.attempts + 1,
+                    run_at=now + timedelta(seconds=self.app.config['JOB_LEASE'])))
+            db.session.commit()
+            if claimed.rowcount == 1:
+                return db.session.get(Job, job_id)
+        return None
+
+    def run_job(self, job):
+        try:
+            handlers[job.kind](**json.loads(job.payload))
+        except Exception:
+            db.session.rollback()
+            job.last_error = traceback.format_exc()
+            if job.attempts >= self.app.config['JOB_MAX_ATTEMPTS']:
+                job.status = 'failed'
+                self.app.logger.error('Job %s (%s) failed: %s', job.id, job.kind,
+                                      job.last_error)
+            else:
+                job.status = 'queued'
+                job.run_at = datetime.now(timezone.utc) + timedelta(
+                    seconds=self.app.config['JOB_RETRY_BACKOFF'] * 2 ** (job.attempts - 1))
+        else:
+            # run_at of a done job is when it finished
+            job.status = 'done'
+            job.payload = '{}'
+            job.run_at = datetime.now(timezone.utc)
+            job.last_error = None
+        db.session.commit()
+
+    def prune(self):
+        """Delete jobs done more than JOB_RETENTION seconds ago, returns how many."""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.app.config['JOB_RETENTION'])
+        deleted = db.session.execute(sa.delete(Job).where(
+            Job.status == 'done', Job.run_at < cutoff)).rowcount
+        db.session.commit()
+        return deleted
+
+    def run_once(self):
+        # runs jobs until none are ready, returns how many were run
+        count = 0
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                job = self.claim()
+                if job is None:
+                    break
+                self.run_job(job)
+                count += 1
+        return count
+
+    def _loop(self):
+        try:
+            while not self.stopping.is_set():
+                if not self.run_once():
+                    self.prune_now_and_then()
+                    self.stopping.wait(self.app.config['JOB_POLL_INTERVAL'])
+        finally:
+            with self.app.app_context():
+                for cleanup in cleanups:
+                    cleanup()
+
+    def prune_now_and_then(self):
+        # at most once a minute across the threads of this worker
+        now = monotonic()
+        if self.pruned_at is not None and now - self.pruned_at < 60:
+            return
+        self.pruned_at = now
+        try:
+            with self.app.app_context():
+                self.prune()
+        except Exception:
+            self.app.logger.exception('Failed to prune done jobs')
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._loop, daemon=True,
+                                      name='job-worker-{}'.format(i))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout)
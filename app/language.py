@@ -0,0 +1,90 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import sqlalchemy as sa
+from app.cache import LRUCache
+
+_profiles_lock = threading.Lock()
+
+
+def load_profiles():
+    # langdetect reads its language profiles on first use, which is slow
+    from langdetect import DetectorFactory
+    from langdetect.detector_factory import init_factory
+    with _profiles_lock:
+        # a fixed seed makes detection deterministic
+        DetectorFactory.seed = 0
+        init_factory()
+
+
+def detect_text(text):
+    # returns the language code of the text, or '' if it cannot be detected
+    from langdetect import detect, LangDetectException
+    load_profiles()
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+def detect_texts(texts):
+    # used by the backfill command in worker processes
+    return [detect_text(text) for text in texts]
+
+
+class LanguageDetector:
+    """Detects post languages, memoized by a hash of the text.
+
+    With LANGUAGE_PRELOAD, profiles are loaded in a background thread when
+    the first request arrives. With LANGUAGE_DETECT_ASYNC, posts are saved
+    without a language and a small thread pool fills it in after commit.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache = None
+        self._executor = None
+        self._preloading = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.cache = LRUCache(maxsize=app.config['LANGUAGE_CACHE_SIZE'])
+        self._preloading = False
+        if app.config['LANGUAGE_PRELOAD']:
+            app.before_request(self._preload)
+
+    def _preload(self):
+        # started by the first request so that flask commands never load langdetect
+        if not self._preloading:
+            self._preloading = True
+            threading.Thread(target=load_profiles, daemon=True,
+                             name='langdetect-preload').start()
+
+    def detect(self, text):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        language = self.cache.get(digest)
+        if language is None:
+            language = detect_text(text)
+            self.cache.set(digest, language)
+        return language
+
+    def detect_later(self, post_id, text):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.app.config['LANGUAGE_DETECT_WORKERS'],
+                    thread_name_prefix='langdetect')
+        return self._executor.submit(self._update_post, post_id, text)
+
+    def _update_post(self, post_id, text):
+        from app import db
+        from app.models import Post
+        language = self.detect(text)
+        with self.app.app_context():
+            db.session.execute(sa.update(Post).where(Post.id == post_id).values(
+                language=language))
+            db.session.commit()
+        return language
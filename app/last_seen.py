@@ -0,0 +1,104 @@
+import atexit
+import threading
+from datetime import datetime, timedelta, timezone
+import sqlalchemy as sa
+
+
+class LastSeenTracker:
+    """Buffers last_seen timestamps in memory and writes them in batches.
+
+    A user is only buffered when their stored timestamp is older than
+    LAST_SEEN_GRANULARITY seconds. The timestamps this tracker wrote in the
+    last LAST_SEEN_GRANULARITY seconds are remembered, since the user
+    objects it is handed may be cached copies that predate them. Buffered timestamps are written every
+    LAST_SEEN_FLUSH_INTERVAL seconds with a single UPDATE, by a background
+    thread that starts on first use. An interval of 0 disables the thread
+    and leaves flushing to the caller.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.pending = {}
+        self.written = {}
+        self.flushed = 0
+        self.flushes = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        atexit.register(self.shutdown)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.pending = {}
+        self.written = {}
+        self.flushed = 0
+        self.flushes = 0
+
+    def touch(self, user, now=None):
+        now = now or datetime.now(timezone.utc)
+        granularity = timedelta(seconds=self.app.config['LAST_SEEN_GRANULARITY'])
+        with self._lock:
+            seen = [value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+                    for value in (self.pending.get(user.id), self.written.get(user.id),
+                                  user.last_seen) if value is not None]
+            if seen and now - max(seen) < granularity:
+                return
+            self.pending[user.id] = now
+        self._start()
+
+    def flush(self):
+        # writes all buffered timestamps with one UPDATE ... CASE statement
+        from app import db
+        from app.models import User
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        try:
+            with self.app.app_context():
+                db.session.execute(
+                    sa.update(User).where(User.id.in_(pending)).values(
+                        last_seen=sa.case(pending, value=User.id)),
+                    execution_options={'synchronize_session': False})
+                db.session.commit()
+        except Exception:
+            # keep the timestamps for the next attempt unless newer ones arrived
+            with self._lock:
+                for user_id, seen in pending.items():
+                    self.pending.setdefault(user_id, seen)
+            self.app.logger.exception('Failed to flush last_seen updates')
+            return 0
+        # older writes no longer hold back a touch, so they are not kept
+        cutoff = datetime.now(timezone.utc) - timedelta(
+            seconds=self.app.config['LAST_SEEN_GRANULARITY'])
+        with self._lock:
+            self.written.update(pending)
+            self.written = {user_id: seen for user_id, seen in self.written.items()
+                            if seen >= cutoff}
+        self.flushed += len(pending)
+        self.flushes += 1
+        return len(pending)
+
+    def metrics(self):
+        return {'pending': len(self.pending), 'flushed': self.flushed,
+                'flushes': self.flushes}
+
+    def shutdown(self):
+        self._stop.set()
+        if self.app is not None:
+            self.flush()
+
+    def _start(self):
+        if self._thread is not None or not self.app.config['LAST_SEEN_FLUSH_INTERVAL']:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='last-seen-flusher')
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.app.config['LAST_SEEN_FLUSH_INTERVAL']):
+            self.flush()
@@ -1,73 +1,205 @@
-from datetime import datetime, timezone
+import re
+import zlib
 from flask import render_template, flash, redirect, url_for, request, g, \
-    current_app
+    current_app, abort, make_response, send_file, Response, stream_with_context
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
-from langdetect import detect, LangDetectException
-from app import db
+import sqlalchemy.orm as so
+from app import db, last_seen_tracker, language_detector, identity_cache, follow_suggestions, \
+    event_stream, post_archive
 from app.main.forms import EditProfileForm, EmptyForm, PostForm
-from app.models import User, Post
-from app.translate import translate
+from app.models import User, Post, Timeline
+from app.translate import translate, translate_many
+from app.pagination import cursor_paginate
+from app.database import replica_bind, read_primary_for_a_while
+from app.etags import etag
+from app.export import DATASETS, FORMATS, batches, parse_checkpoint
+from app.search import get_search_index
+from app.avatars import fetch_avatar, identicon_svg, image_type
 from app.main import bp
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        last_seen_tracker.touch(current_user)
     g.locale = str(get_locale())
 
+# cheap summaries of what each page shows, used by @etag before the page is built
+def index_version():
+    latest = current_user.timeline_posts().order_by(None).with_only_columns(sa.func.max(Post.id))
+    return current_user.following_count, db.session.scalar(latest, bind_arguments=replica_bind()), \
+        follow_suggestions.version()
+
+def explore_version():
+    return db.session.scalar(sa.select(sa.func.max(Post.id)), bind_arguments=replica_bind())
+
+def user_version(username):
+    latest = sa.select(sa.func.max(Post.id)).where(Post.user_id == User.id).scalar_subquery()
+    row = db.session.execute(sa.select(
+        User.id, User.about_me, User.last_seen, User.followers_count, User.following_count,
+        latest).where(User.username == username), bind_arguments=replica_bind()).first()
+    # your own profile shows who to follow
+    suggestions = follow_suggestions.version() if username == current_user.username else None
+    return tuple(row) if row else None, current_user.following_count, suggestions
+
+# users followed by the most people current_user follows, with that count
+def suggested_users():
+    scores = follow_suggestions.suggest(current_user.id)
+    if not scores:
+        return []
+    users = {user.id: user for user in db.session.scalars(
+        sa.select(User).where(User.id.in_([user_id for user_id, _ in scores])),
+        bind_arguments=replica_bind())}
+    return [(users[user_id], mutual) for user_id, mutual in scores if user_id in users]
+
 # the front page of the website to view followers and your own posts 
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@etag(index_version)
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
+        language = None
+        if not current_app.config['LANGUAGE_DETECT_ASYNC']:
+            language = language_detector.detect(form.post.data)
         post = Post(body=form.post.data, author=current_user, language=language)
         db.session.add(post)
+        current_user.post_count = User.post_count + 1
+        db.session.flush()
+        Timeline.fan_out(post)
+        get_search_index().add(post)
         db.session.commit()
+        identity_cache.invalidate(current_user)
+        event_stream.publish_post(post)
+        read_primary_for_a_while()
+        if language is None:
+            language_detector.detect_later(post.id, post.body)
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
+    query = current_user.timeline_posts().options(so.joinedload(Post.author))
+    posts = cursor_paginate(query, User.timeline_columns(),
+                            cursor=request.args.get('cursor'), page=request.args.get('page', type=int),
+                            per_page=current_app.config['POSTS_PER_PAGE'],
+                            bind_arguments=replica_bind(), keys=('timestamp', 'id'))
+    next_url = url_for('main.index', cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', cursor=posts.prev_cursor) \
         if posts.has_prev else None
-    return render_template('index.html', title=_('Home'), form=form, posts=posts.items, next_url=next_url, prev_url=prev_url)
+    return render_template('index.html', title=_('Home'), form=form, posts=posts.items, next_url=next_url, prev_url=prev_url,
+                           suggestions=suggested_users())
+
+# pushes the ids of new posts by followed users to the home page as they are posted
+@bp.route('/events')
+@login_required
+def events():
+    if not current_app.config['EVENTS']:
+        abort(404)
+    authors = db.session.scalars(current_user.following.select().with_only_columns(User.id))
+    subscriber = event_stream.subscribe(current_user.id, authors)
+    if subscriber is None:
+        abort(503)
+    # the stream outlives the request, so it must not use the request or the session
+    response = Response(event_stream.stream(subscriber), mimetype='text/event-stream')
+    # a HEAD request or a client gone before the first chunk never runs the stream
+    response.call_on_close(lambda: event_stream.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 # the web page to show all the posts
 @bp.route('/explore')
 @login_required
+@etag(explore_version)
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
+    query = sa.select(Post).options(so.joinedload(Post.author)).order_by(Post.timestamp.desc())
+    posts = cursor_paginate(query, (Post.timestamp, Post.id),
+                            cursor=request.args.get('cursor'), page=request.args.get('page', type=int),
+                            per_page=current_app.config['POSTS_PER_PAGE'],
+                            bind_arguments=replica_bind())
+    next_url = url_for('main.explore', cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
+    prev_url = url_for('main.explore', cursor=posts.prev_cursor) \
         if posts.has_prev else None
     return render_template('index.html', title=_('Explore'), posts=posts.items, next_url=next_url, prev_url=prev_url)
 
+# the web page for searching posts, best matches first
+@bp.route('/search')
+@login_required
+def search():
+    q = request.args.get('q', '')
+    posts = get_search_index().search(q, cursor=request.args.get('cursor'),
+                                      per_page=current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.search', q=q, cursor=posts.next_cursor) \
+        if posts.has_next else None
+    return render_template('index.html', title=_('Search'), posts=posts.items, next_url=next_url, prev_url=None)
+
 # the web page for your profile
 @bp.route('/user/<username>')
 @login_required
+@etag(user_version)
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+    # old posts may have been moved to the archive tables, see app/archive.py
+    posts = post_archive.user_posts(user, cursor=request.args.get('cursor'),
+                                    page=request.args.get('page', type=int),
+                                    per_page=current_app.config['POSTS_PER_PAGE'],
+                                    bind_arguments=replica_bind())
+    next_url = url_for('main.user', username=user.username, cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.user', username=user.username, cursor=posts.prev_cursor) if posts.has_prev else None
+    relationship = User.viewer_relationships(current_user, [user])[user.id]
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items, next_url=next_url, prev_url=prev_url, form=form)
+    suggestions = suggested_users() if user == current_user else []
+    return render_template('user.html', user=user, relationship=relationship, posts=posts.items, next_url=next_url, prev_url=prev_url, form=form,
+                           suggestions=suggestions)
+
+# downloads your own posts or follows as a gzip compressed file, built as it is sent
+@bp.route('/user/<username>/export')
+@login_required
+def export(username):
+    if username != current_user.username:
+        abort(403)
+    dataset = request.args.get('dataset', 'posts')
+    format = request.args.get('format', 'jsonl')
+    if dataset not in DATASETS or format not in FORMATS:
+        abort(400)
+    try:
+        after = parse_checkpoint(dataset, request.args['after']) if request.args.get('after') else None
+    except ValueError:
+        abort(400)
+    user_id = current_user.id
+
+    def generate():
+        compressor = zlib.compressobj(wbits=31)  # 31 writes a gzip header and trailer
+        for text, _, _ in batches(dataset, format, user_id=user_id, after=after):
+            yield compressor.compress(text.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+    return Response(stream_with_context(generate()), mimetype='application/gzip', headers={
+        'Content-Disposition': 'attachment; filename={}-{}.{}.gz'.format(username, dataset, format)})
+
+# serves gravatar images from a local cache so pages do not wait on gravatar
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):
+    # only the avatars of users of this site, at the sizes the pages use
+    if not re.fullmatch('[0-9a-f]{32}', digest) or size not in current_app.config['AVATAR_SIZES']:
+        abort(404)
+    if db.session.scalar(sa.select(User.id).where(User.avatar_hash == digest).limit(1)) is None:
+        abort(404)
+    path = fetch_avatar(digest, size)
+    if path is None:
+        response = make_response(identicon_svg(digest, size))
+        response.mimetype = 'image/svg+xml'
+        response.cache_control.public = True
+        response.cache_control.max_age = 300
+        response.add_etag()
+        return response.make_conditional(request)
+    with open(path, 'rb') as f:
+        mimetype = image_type(f.read(8))
+    return send_file(path, mimetype=mimetype, conditional=True, etag=True,
+                     max_age=current_app.config['AVATAR_MAX_AGE'])
 
 # The web page for editing your profile
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -78,6 +210,8 @@ def edit_profile():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
+        identity_cache.invalidate(current_user)
+        read_primary_for_a_while()
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -101,6 +235,7 @@ def follow(username):
             return redirect(url_for('main.user', username=username))
         current_user.follow(user)
         db.session.commit()
+        read_primary_for_a_while()
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -122,6 +257,7 @@ def unfollow(username):
             return redirect(url_for('main.user', username=username))
         current_user.unfollow(user)
         db.session.commit()
+        read_primary_for_a_while()
         flash(_('You are not following %(username)s.', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -132,3 +268,30 @@ def unfollow(username):
 def translate_text():
     data = request.get_json()
     return {'text': translate(data['text'], data['source_language'], data['dest_language'])}
+
+# translates many posts into the same language with one call to the translator
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_posts():
+    if not current_app.config['MS_TRANSLATOR_KEY']:
+        return {'error': _('Error: the translation service is not configured.')}, 503
+    data = request.get_json(silent=True)
+    try:
+        post_ids = [int(post_id) for post_id in data['post_ids']][:100]
+        dest_language = data['dest_language']
+    except (TypeError, KeyError, ValueError):
+        dest_language = None
+    if not isinstance(dest_language, str) or not dest_language:
+        return {'error': _('Error: send a list of post_ids and a dest_language.')}, 400
+    posts = db.session.scalars(sa.select(Post).where(Post.id.in_(post_ids))).all()
+    by_language = {}
+    for post in posts:
+        if post.language and post.language != dest_language:
+            by_language.setdefault(post.language, []).append(post)
+    translations = {}
+    for language, group in by_language.items():
+        texts = translate_many([post.body for post in group], language, dest_language)
+        if texts is None:
+            return {'error': _('Error: the translation service failed.')}, 502
+        translations.update({str(post.id): text for post, text in zip(group, texts)})
+    return {'translations': translations}
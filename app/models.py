@@ -1,33 +1,45 @@
+from collections import namedtuple
 from datetime import datetime, timezone
 from hashlib import md5
 from time import time
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
-from flask import current_app
+from flask import current_app, url_for
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
-from app import db, login
+from app import db, login, identity_cache, follow_suggestions, post_archive
+from app import passwords
 
 # making the followers table
 followers = sa.Table(
     'followers',
     db.metadata,
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
-    sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True)
+    sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+    # the primary key leads on follower_id, this serves the lookups of a user's followers
+    sa.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
+# what a viewer sees on a profile: whether they follow the user and the user's counts
+Relationship = namedtuple('Relationship', ['is_following', 'followers_count', 'following_count'])
+
 # making the users table with variables for adding folowers and following 
 class User(UserMixin, db.Model):
     # making the columns of the database table
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     username: so.Mapped[str] = so.mapped_column(sa.String(64), index=True, unique=True)
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True, unique=True)
+    # md5 of the lowercased email, used to build gravatar urls without hashing on every render
+    avatar_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True)
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
     last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(
         default=lambda: datetime.now(timezone.utc))
+    # denormalized counters, kept in step by follow/unfollow and new posts
+    followers_count: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    following_count: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
+    post_count: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
 
     posts: so.WriteOnlyMapped['Post'] = so.relationship(
         back_populates='author')
@@ -45,36 +57,105 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash_password(password)
+        identity_cache.invalidate(self)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.check_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash)
+
+    @so.validates('email')
+    def validate_email(self, key, email):
+        self.avatar_hash = md5(email.lower().encode('utf-8')).hexdigest() if email else None
+        return email
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        if self.avatar_hash is None:
+            # the avatar proxy only knows stored hashes, see 'flask avatars backfill'
+            return self.gravatar_url(md5(self.email.lower().encode('utf-8')).hexdigest(), size)
+        return self.avatar_url(self.avatar_hash, size)
+
+    @staticmethod
+    def avatar_url(digest, size):
+        if current_app.config['AVATAR_PROXY']:
+            return url_for('main.avatar', digest=digest, size=size)
+        return User.gravatar_url(digest, size)
+
+    @staticmethod
+    def gravatar_url(digest, size):
         return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
 
+    @classmethod
+    def fill_avatar_hashes(cls, batch_size=1000):
+        """Store avatar_hash for users created before the column existed, returns how many."""
+        filled = 0
+        while True:
+            rows = db.session.execute(sa.select(cls.id, cls.email).where(
+                cls.avatar_hash.is_(None)).limit(batch_size)).all()
+            if not rows:
+                return filled
+            db.session.execute(sa.update(cls), [
+                {'id': user_id, 'avatar_hash': md5(email.lower().encode('utf-8')).hexdigest()}
+                for user_id, email in rows])
+            db.session.commit()
+            filled += len(rows)
+
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self.following_count = User.following_count + 1
+            user.followers_count = User.followers_count + 1
+            Timeline.backfill(self, user)
+            identity_cache.invalidate(self, user)
+            follow_suggestions.record_on_commit(db.session, [(self.id, user.id)], True)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.following_count = User.following_count - 1
+            user.followers_count = User.followers_count - 1
+            Timeline.prune(self, user)
+            identity_cache.invalidate(self, user)
+            follow_suggestions.record_on_commit(db.session, [(self.id, user.id)], False)
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
-    def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+    @staticmethod
+    def viewer_relationships(viewer, users):
+        # follow state and counts for many users in a single query
+        follows = followers.alias()
+        query = sa.select(
+            User.id,
+            sa.select(follows).where(
+                follows.c.follower_id == viewer.id,
+                follows.c.followed_id == User.id).exists(),
+            User.followers_count,
+            User.following_count,
+        ).where(User.id.in_([user.id for user in users]))
+        return {row[0]: Relationship(*row[1:]) for row in db.session.execute(query)}
 
-    def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+    @staticmethod
+    def repair_counters(dry_run=False, user_ids=None):
+        # recomputes the denormalized counters and fixes the rows that drifted
+        counts = {
+            'followers_count': sa.select(sa.func.count()).where(
+                followers.c.followed_id == User.id).scalar_subquery(),
+            'following_count': sa.select(sa.func.count()).where(
+                followers.c.follower_id == User.id).scalar_subquery(),
+            'post_count': sa.select(sa.func.count()).where(
+                Post.user_id == User.id).scalar_subquery() + post_archive.count_posts(User.id),
+        }
+        drifted = sa.or_(*[getattr(User, name) != count for name, count in counts.items()])
+        if user_ids is not None:
+            drifted = sa.and_(User.id.in_(user_ids), drifted)
+        if dry_run:
+            return db.session.scalar(sa.select(sa.func.count()).where(drifted))
+        return db.session.execute(
+            sa.update(User).where(drifted).values(**counts)).rowcount
 
     def following_posts(self):
         Author = so.aliased(User)
@@ -88,6 +169,29 @@ class User(UserMixin, db.Model):
             .order_by(Post.timestamp.desc())
         )
 
+    def timeline_posts(self):
+        query = sa.select(Post).join(Timeline, Timeline.post_id == Post.id) \
+            .where(Timeline.user_id == self.id)
+        if current_app.config['TIMELINE_FANOUT_THRESHOLD'] is not None:
+            # hybrid mode: posts from very popular authors are not fanned out,
+            # so they are pulled in at read time instead
+            popular = sa.select(followers.c.followed_id).where(
+                followers.c.follower_id == self.id,
+                sa.not_(Timeline.fans_out(followers.c.followed_id)))
+            query = sa.select(Post).where(sa.or_(
+                Post.id.in_(sa.select(Timeline.post_id).where(
+                    Timeline.user_id == self.id)),
+                Post.user_id.in_(popular)))
+        return query.order_by(*[column.desc() for column in self.timeline_columns()])
+
+    @staticmethod
+    def timeline_columns():
+        # the sort key of timeline_posts(), the timeline's own columns when every
+        # post is fanned out so pages are read in index order
+        if current_app.config['TIMELINE_FANOUT_THRESHOLD'] is not None:
+            return Post.timestamp, Post.id
+        return Timeline.timestamp, Timeline.post_id
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
@@ -104,17 +208,163 @@ class User(UserMixin, db.Model):
 
 @login.user_loader
 def load_user(id):
-    return db.session.get(User, int(id))
+    return identity_cache.load(int(id))
 
 # creates the posts table in the database
 class Post(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
 
     author: so.Mapped[User] = so.relationship(back_populates='posts')
 
+    # a user's posts newest first straight from the index, without sorting
+    __table_args__ = (
+        sa.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+
+# the precomputed home timeline, one row for every post a user should see
+class Timeline(db.Model):
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), primary_key=True)
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id), primary_key=True)
+    timestamp: so.Mapped[datetime] = so.mapped_column()
+
+    __table_args__ = (
+        sa.Index('ix_timeline_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id'),
+    )
+
+    def __repr__(self):
+        return '<Timeline {} {}>'.format(self.user_id, self.post_id)
+
+    @staticmethod
+    def fans_out(author_id):
+        # authors with more followers than the threshold are read at request time
+        threshold = current_app.config['TIMELINE_FANOUT_THRESHOLD']
+        if threshold is None:
+            return sa.true()
+        author = so.aliased(User)
+        count = sa.select(author.followers_count).where(
+            author.id == author_id).scalar_subquery()
+        return count <= threshold
+
+    @staticmethod
+    def fan_out(post):
+        # writes the post into the author's timeline and the timelines of their followers
+        own = sa.select(sa.literal(post.user_id), sa.literal(post.id),
+                        sa.literal(post.timestamp, sa.DateTime))
+        readers = sa.select(followers.c.follower_id, sa.literal(post.id),
+                            sa.literal(post.timestamp, sa.DateTime)).where(
+            followers.c.followed_id == post.user_id,
+            Timeline.fans_out(post.user_id))
+        db.session.execute(sa.insert(Timeline).from_select(
+            ['user_id', 'post_id', 'timestamp'], sa.union_all(own, readers)))
+
+    @staticmethod
+    def backfill(follower, followed):
+        # copies the recent posts of a newly followed user into the follower's timeline
+        posts = sa.select(sa.literal(follower.id), Post.id, Post.timestamp).where(
+            Post.user_id == followed.id,
+            Timeline.fans_out(followed.id),
+            ~sa.select(Timeline.post_id).where(
+                Timeline.user_id == follower.id,
+                Timeline.post_id == Post.id).exists()
+        ).order_by(Post.timestamp.desc()).limit(
+            current_app.config['TIMELINE_BACKFILL_LIMIT'])
+        db.session.execute(sa.insert(Timeline).from_select(
+            ['user_id', 'post_id', 'timestamp'], posts))
+
+    @staticmethod
+    def prune(follower, followed):
+        # removes the posts of an unfollowed user from the follower's timeline
+        db.session.execute(sa.delete(Timeline).where(
+            Timeline.user_id == follower.id,
+            Timeline.post_id.in_(
+                sa.select(Post.id).where(Post.user_id == followed.id))))
+
+    @staticmethod
+    def rebuild(user_ids=None):
+        # recomputes timelines from the posts and followers tables
+        delete = sa.delete(Timeline)
+        own = sa.select(Post.user_id, Post.id, Post.timestamp)
+        followed = sa.select(followers.c.follower_id, Post.id, Post.timestamp) \
+            .join(Post, Post.user_id == followers.c.followed_id) \
+            .where(Timeline.fans_out(followers.c.followed_id))
+        if user_ids is not None:
+            delete = delete.where(Timeline.user_id.in_(user_ids))
+            own = own.where(Post.user_id.in_(user_ids))
+            followed = followed.where(followers.c.follower_id.in_(user_ids))
+        db.session.execute(delete)
+        result = db.session.execute(sa.insert(Timeline).from_select(
+            ['user_id', 'post_id', 'timestamp'], sa.union_all(own, followed)))
+        return result.rowcount
+
+
+# translations already fetched from the translator, keyed by a hash of the source text
+class Translation(db.Model):
+    digest: so.Mapped[str] = so.mapped_column(sa.String(64), primary_key=True)
+    source_language: so.Mapped[str] = so.mapped_column(sa.String(5), primary_key=True)
+    dest_language: so.Mapped[str] = so.mapped_column(sa.String(5), primary_key=True)
+    text: so.Mapped[str] = so.mapped_column(sa.Text)
+    timestamp: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return '<Translation {} {}>'.format(self.digest, self.dest_language)
+
+
+# background jobs waiting to be run by 'flask worker', see app/jobs.py
+class Job(db.Model):
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    kind: so.Mapped[str] = so.mapped_column(sa.String(64))
+    payload: so.Mapped[str] = so.mapped_column(sa.Text)
+    status: so.Mapped[str] = so.mapped_column(sa.String(16), default='queued')
+    attempts: so.Mapped[int] = so.mapped_column(default=0)
+    run_at: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+    last_error: so.Mapped[Optional[str]] = so.mapped_column(sa.Text)
+    timestamp: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        sa.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return '<Job {} {}>'.format(self.id, self.kind)
+
+
+# the built-in inverted index used for search when SQLite FTS5 is not available
+class SearchTerm(db.Model):
+    term: so.Mapped[str] = so.mapped_column(sa.String(64), primary_key=True)
+    post_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Post.id), primary_key=True,
+                                               index=True)
+
+    def __repr__(self):
+        return '<SearchTerm {} {}>'.format(self.term, self.post_id)
+
+
+# recent events passed between processes by the 'database' events broker, see app/events.py
+class Event(db.Model):
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    payload: so.Mapped[str] = so.mapped_column(sa.Text)
+    timestamp: so.Mapped[datetime] = so.mapped_column(
+        index=True, default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return '<Event {}>'.format(self.id)
+
+
+# one row for each month of posts moved to an archive table, see app/archive.py
+class PostPartition(db.Model):
+    month: so.Mapped[str] = so.mapped_column(sa.String(7), primary_key=True)
+    table_name: so.Mapped[str] = so.mapped_column(sa.String(64))
+    post_count: so.Mapped[int] = so.mapped_column(default=0)
+    oldest: so.Mapped[datetime] = so.mapped_column()
+    newest: so.Mapped[datetime] = so.mapped_column()
+    archived_at: so.Mapped[datetime] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return '<PostPartition {}>'.format(self.month)
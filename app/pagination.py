@@ -0,0 +1,104 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from app import db
+
+
+def encode_cursor(direction, values):
+    # turns a sort key into an opaque url safe token
+    payload = json.dumps([direction, [
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values]], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, columns):
+    # returns (direction, values) or None if the token is not valid
+    try:
+        payload = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, values = json.loads(payload)
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            return None
+        return direction, [
+            datetime.fromisoformat(value) if isinstance(column.type, sa.DateTime) else value
+            for column, value in zip(columns, values)]
+    except (binascii.Error, ValueError, TypeError):
+        return None
+
+
+def _after(columns, values, descending):
+    # builds (a, b) < (x, y) without relying on row value support in the database
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column < value if descending else column > value
+    return sa.or_(
+        column < value if descending else column > value,
+        sa.and_(column == value, _after(columns[1:], values[1:], descending)))
+
+
+def _seek(columns, values, descending):
+    # the redundant bound on the first column lets the database seek into an
+    # index instead of filtering the OR row by row
+    column, value = columns[0], values[0]
+    bound = column <= value if descending else column >= value
+    return sa.and_(bound, _after(columns, values, descending))
+
+
+def seek(query, columns, cursor=None):
+    """Order ``query`` newest first, starting after a 'next' ``cursor``."""
+    decoded = decode_cursor(cursor, columns) if cursor else None
+    if decoded is not None and decoded[0] == 'next':
+        query = query.where(_seek(columns, decoded[1], True))
+    return query.order_by(None).order_by(*[column.desc() for column in columns])
+
+
+class CursorPagination:
+    def __init__(self, items, keys, has_next, has_prev):
+        self.items = items
+        self.next_cursor = encode_cursor('next', self._key(items[-1], keys)) \
+            if has_next and items else None
+        self.prev_cursor = encode_cursor('prev', self._key(items[0], keys)) \
+            if has_prev and items else None
+        self.has_next = self.next_cursor is not None
+        self.has_prev = self.prev_cursor is not None
+
+    @staticmethod
+    def _key(item, keys):
+        return [getattr(item, key) for key in keys]
+
+
+def cursor_paginate(query, columns, cursor=None, page=None, per_page=25,
+                    bind_arguments=None, keys=None):
+    """Paginate a select in descending order of ``columns`` without counting rows.
+
+    ``cursor`` is a token from a previous page. ``page`` is only used for old
+    ``?page=N`` links, which are served with an offset. ``bind_arguments``
+    is passed to the session, to read from another bind. ``keys`` are the
+    item attributes that hold the ``columns`` values, by default their keys.
+    """
+    keys = keys or [column.key for column in columns]
+    query = query.order_by(None)
+    newest_first = [column.desc() for column in columns]
+    decoded = decode_cursor(cursor, columns) if cursor else None
+    if decoded is None:
+        page = max(page or 1, 1)
+        rows = db.session.scalars(query.order_by(*newest_first).offset(
+            (page - 1) * per_page).limit(per_page + 1),
+            bind_arguments=bind_arguments).all()
+        return CursorPagination(rows[:per_page], keys, len(rows) > per_page, page > 1)
+    direction, values = decoded
+    if direction == 'next':
+        rows = db.session.scalars(
+            query.where(_seek(columns, values, True)).order_by(*newest_first)
+            .limit(per_page + 1), bind_arguments=bind_arguments).all()
+        return CursorPagination(rows[:per_page], keys, len(rows) > per_page, True)
+    rows = db.session.scalars(
+        query.where(_seek(columns, values, False))
+        .order_by(*[column.asc() for column in columns]).limit(per_page + 1),
+        bind_arguments=bind_arguments).all()
+    if not rows:
+        return cursor_paginate(query, columns, per_page=per_page,
+                               bind_arguments=bind_arguments, keys=keys)
+    return CursorPagination(rows[:per_page][::-1], keys, True, len(rows) > per_page)
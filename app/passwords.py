@@ -0,0 +1,51 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+
+
+class PasswordCheckBusy(Exception):
+    """Raised when too many password checks are already waiting."""
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+
+@lru_cache(maxsize=8)
+def _hash_prefix(method):
+    # werkzeug writes the method with all its parameters in front of the salt
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != \
+        _hash_prefix(current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def check_password(password_hash, password):
+    """Check a password in the hashing pool, if PASSWORD_HASH_WORKERS is set.
+
+    At most PASSWORD_HASH_QUEUE checks wait for the pool, further ones
+    raise PasswordCheckBusy instead of tying up more request threads.
+    """
+    global _executor, _slots
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if not workers:
+        return check_password_hash(password_hash, password)
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='password-hash')
+            _slots = threading.BoundedSemaphore(workers + current_app.config['PASSWORD_HASH_QUEUE'])
+    if not _slots.acquire(blocking=False):
+        raise PasswordCheckBusy()
+    try:
+        return _executor.submit(check_password_hash, password_hash, password).result()
+    finally:
+        _slots.release()
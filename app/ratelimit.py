@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+from functools import wraps
+from time import monotonic
+from flask import current_app, render_template, request
+
+
+class TokenBucket:
+    """Token buckets kept in memory, one for each key.
+
+    Every bucket holds up to ``capacity`` tokens and regains ``rate`` tokens
+    a second. Only the ``maxsize`` most recently used buckets are kept.
+    """
+
+    def __init__(self, capacity, rate, maxsize=100000):
+        self.capacity = capacity
+        self.rate = rate
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def take(self, keys):
+        """Take a token from the bucket of every key, or from none of them.
+
+        Returns 0 on success, or the seconds until all buckets have a token.
+        """
+        now = monotonic()
+        with self._lock:
+            tokens = {key: self._tokens(key, now) for key in keys}
+            empty = [value for value in tokens.values() if value < 1]
+            if empty:
+                return max((1 - value) / self.rate for value in empty)
+            for key, value in tokens.items():
+                self._buckets[key] = (value - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return 0
+
+
+class RateLimiter:
+    """Rejects POST requests that come too often from one IP or for one account.
+
+    Each limited view gets its own buckets, which allow a burst of
+    RATE_LIMIT_BURST attempts and then RATE_LIMIT_PER_MINUTE. Rejected
+    requests get a 429 response before the view runs.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.buckets = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.buckets = {}
+
+    def limit(self, field):
+        """Limit POSTs to a view by client IP and by the ``field`` form value."""
+        def decorator(f):
+            @wraps(f)
+            def wrapped(*args, **kwargs):
+                per_minute = current_app.config['RATE_LIMIT_PER_MINUTE']
+                if request.method != 'POST' or not per_minute:
+                    return f(*args, **kwargs)
+                bucket = self.buckets.get(request.endpoint)
+                if bucket is None:
+                    bucket = self.buckets.setdefault(request.endpoint, TokenBucket(
+                        current_app.config['RATE_LIMIT_BURST'], per_minute / 60))
+                keys = ['ip:' + (request.remote_addr or '')]
+                value = request.form.get(field, '').strip().lower()
+                if value:
+                    keys.append('{}:{}'.format(field, value))
+                wait = bucket.take(keys)
+                if wait:
+                    response = current_app.make_response(
+                        (render_template('errors/429.html'), 429))
+                    response.retry_after = int(wait) + 1
+                    return response
+                return f(*args, **kwargs)
+            return wrapped
+        return decorator
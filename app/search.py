@@ -0,0 +1,167 @@
+import re
+from abc import ABC, abstractmethod
+from flask import current_app
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import db
+from app.models import Post, SearchTerm
+from app.pagination import encode_cursor, decode_cursor
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return list(dict.fromkeys(token[:64] for token in TOKEN_RE.findall(text.lower())))
+
+
+class SearchPage:
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+
+
+class SearchIndex(ABC):
+    """Base class for search backends.
+
+    Backends implement the abstract methods below and ``search`` pages
+    through their matches by (score, post_id).
+    """
+
+    name = None
+
+    @abstractmethod
+    def add(self, post):
+        """Index a new post, in the caller's transaction."""
+
+    @abstractmethod
+    def remove(self, post_ids):
+        """Drop the posts with these ids from the index."""
+
+    @abstractmethod
+    def reindex(self):
+        """Rebuild the index from the post table, returns the number of posts."""
+
+    @abstractmethod
+    def matches(self, terms):
+        """A subquery of (post_id, score) rows, where a higher score is a better match."""
+
+    def search(self, text, cursor=None, per_page=25):
+        terms = tokenize(text)
+        if not terms:
+            return SearchPage([], None)
+        matches = self.matches(terms)
+        query = sa.select(matches.c.post_id, matches.c.score)
+        decoded = decode_cursor(cursor, (matches.c.score, matches.c.post_id)) if cursor else None
+        if decoded is not None:
+            score, post_id = decoded[1]
+            query = query.where(sa.or_(
+                matches.c.score < score,
+                sa.and_(matches.c.score == score, matches.c.post_id < post_id)))
+        rows = db.session.execute(query.order_by(
+            matches.c.score.desc(), matches.c.post_id.desc()).limit(per_page + 1)).all()
+        next_cursor = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            next_cursor = encode_cursor('next', [rows[-1].score, rows[-1].post_id])
+        posts = {post.id: post for post in db.session.scalars(
+            sa.select(Post).options(so.joinedload(Post.author))
+            .where(Post.id.in_([row.post_id for row in rows])))}
+        return SearchPage([posts[row.post_id] for row in rows if row.post_id in posts],
+                          next_cursor)
+
+
+class FTS5Index(SearchIndex):
+    """Search with an SQLite FTS5 table whose rowids are post ids, ranked by bm25."""
+
+    name = 'fts5'
+
+    def __init__(self):
+        self._created = set()
+
+    def _ensure_table(self):
+        # created in the current transaction so it never waits on another connection
+        engine = db.engine
+        if engine not in self._created:
+            db.session.execute(sa.text(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(body)'))
+            self._created.add(engine)
+
+    @staticmethod
+    def available():
+        if db.engine.dialect.name != 'sqlite':
+            return False
+        return bool(db.session.scalar(sa.text(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5')")))
+
+    def add(self, post):
+        self._ensure_table()
+        db.session.execute(sa.text('INSERT INTO post_fts (rowid, body) VALUES (:id, :body)'),
+                           {'id': post.id, 'body': post.body})
+
+    def remove(self, post_ids):
+        self._ensure_table()
+        db.session.execute(sa.text('DELETE FROM post_fts WHERE rowid IN :ids').bindparams(
+            sa.bindparam('ids', expanding=True)), {'ids': list(post_ids)})
+
+    def reindex(self):
+        self._ensure_table()
+        db.session.execute(sa.text('DELETE FROM post_fts'))
+        return db.session.execute(sa.text(
+            'INSERT INTO post_fts (rowid, body) SELECT id, body FROM post')).rowcount
+
+    def matches(self, terms):
+        self._ensure_table()
+        # every term is quoted so user input cannot use the FTS5 query syntax
+        query = ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        return sa.text(
+            'SELECT rowid AS post_id, -bm25(post_fts) AS score FROM post_fts '
+            'WHERE post_fts MATCH :query').bindparams(query=query).columns(
+            post_id=sa.Integer, score=sa.Float).subquery('matches')
+
+
+class InvertedIndex(SearchIndex):
+    """Search with the SearchTerm table, ranked by how many terms a post matches."""
+
+    name = 'inverted'
+
+    def add(self, post):
+        terms = tokenize(post.body)
+        if terms:
+            db.session.execute(sa.insert(SearchTerm), [
+                {'term': term, 'post_id': post.id} for term in terms])
+
+    def remove(self, post_ids):
+        db.session.execute(sa.delete(SearchTerm).where(SearchTerm.post_id.in_(post_ids)))
+
+    def reindex(self, batch_size=10000):
+        db.session.execute(sa.delete(SearchTerm))
+        total = 0
+        rows = []
+        for post_id, body in db.session.execute(
+                sa.select(Post.id, Post.body).execution_options(yield_per=batch_size)):
+            rows.extend({'term': term, 'post_id': post_id} for term in tokenize(body))
+            total += 1
+            if len(rows) >= batch_size:
+                db.session.execute(sa.insert(SearchTerm), rows)
+                rows = []
+        if rows:
+            db.session.execute(sa.insert(SearchTerm), rows)
+        return total
+
+    def matches(self, terms):
+        return sa.select(
+            SearchTerm.post_id,
+            sa.cast(sa.func.count(), sa.Float).label('score')
+        ).where(SearchTerm.term.in_(terms)).group_by(SearchTerm.post_id).subquery('matches')
+
+
+def get_search_index():
+    # picks the backend from SEARCH_BACKEND once per application
+    app = current_app._get_current_object()
+    if 'search' not in app.extensions:
+        backend = app.config['SEARCH_BACKEND']
+        if backend == 'auto':
+            backend = 'fts5' if FTS5Index.available() else 'inverted'
+        app.extensions['search'] = FTS5Index() if backend == 'fts5' else InvertedIndex()
+    return app.extensions['search']
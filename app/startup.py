@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+# modules that are slow to import and must only be loaded when first used
+LAZY_MODULES = ('requests', 'langdetect', 'alembic')
+
+
+def import_times(statement='import microblog'):
+    """Run ``statement`` in a new interpreter and time every import it makes.
+
+    Returns (module, self, cumulative) tuples in microseconds, in the order
+    the imports finished, as reported by ``python -X importtime``. The app
+    is created in testing mode, so it does not write to the log.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            cwd=root, env=dict(os.environ, MICROBLOG_TESTING='1'),
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, module = line[len('import time:'):].split('|')
+        times.append((module.strip(), int(own), int(cumulative)))
+    return times
+
+
+def by_package(times):
+    # total time spent importing each top level package, slowest first
+    totals = {}
+    for module, own, cumulative in times:
+        package = module.split('.')[0]
+        totals[package] = totals.get(package, 0) + own
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
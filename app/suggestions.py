@@ -0,0 +1,224 @@
+import heapq
+import os
+import struct
+import threading
+from array import array
+from collections import Counter
+from time import time
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+# built_at, number of offsets and number of targets, followed by the two arrays
+HEADER = struct.Struct('<dqq')
+
+
+class FollowGraph:
+    """The followers table in compressed sparse row form.
+
+    ``targets`` holds the followed ids of every follower, grouped by
+    follower, and the follows of user ``u`` are
+    ``targets[offsets[u]:offsets[u + 1]]``. A million follows take about
+    4MB, a small fraction of the memory the same edges take as Python sets.
+    """
+
+    def __init__(self, offsets, targets, built_at):
+        self.offsets = offsets
+        self.targets = targets
+        self.built_at = built_at
+
+    @classmethod
+    def from_edges(cls, edges, built_at=None):
+        """Build the graph from (follower, followed) pairs sorted by follower."""
+        offsets = array('q', [0])
+        targets = array('i')
+        for follower, followed in edges:
+            while len(offsets) <= follower:
+                offsets.append(len(targets))
+            targets.append(followed)
+        offsets.append(len(targets))
+        return cls(offsets, targets, time() if built_at is None else built_at)
+
+    def following(self, user_id):
+        if user_id + 1 >= len(self.offsets):
+            return self.targets[:0]
+        return self.targets[self.offsets[user_id]:self.offsets[user_id + 1]]
+
+    def save(self, path):
+        # written next to the target and renamed, so readers never see half a file
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(self.built_at, len(self.offsets), len(self.targets)))
+            self.offsets.tofile(f)
+            self.targets.tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            built_at, offsets_count, targets_count = HEADER.unpack(f.read(HEADER.size))
+            offsets = array('q')
+            offsets.fromfile(f, offsets_count)
+            targets = array('i')
+            targets.fromfile(f, targets_count)
+        return cls(offsets, targets, built_at)
+
+
+class FollowSuggestions:
+    """Suggests users to follow, ranked by how many of your follows follow them.
+
+    The follow graph is kept in memory as a FollowGraph. Follows and
+    unfollows committed by this process are recorded on top of it until the
+    next full rebuild, which drops the changes it already includes. With
+    SUGGESTIONS_SNAPSHOT set the graph is loaded from the file that
+    'flask suggestions rebuild' writes, whenever the file changes, so all
+    workers share one build. Otherwise each process builds the graph from
+    the database in a background thread, on first use and again when it is
+    SUGGESTIONS_MAX_AGE seconds old; there are no suggestions until the
+    first build is done.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.graph = None
+        self.changes = {}
+        self.recorded = 0
+        self._snapshot_mtime = None
+        self._rebuilding = False
+        self._builder = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.graph = None
+        self.changes = {}
+        self.recorded = 0
+        self._snapshot_mtime = None
+        if not sa.event.contains(so.Session, 'after_commit', self._committed):
+            sa.event.listen(so.Session, 'after_commit', self._committed)
+            sa.event.listen(so.Session, 'after_soft_rollback', self._rolled_back)
+
+    def record(self, pairs, following):
+        """Apply follows, or unfollows when ``following`` is false, to the graph.
+
+        Only for changes that are already committed, see record_on_commit.
+        """
+        now = time()
+        with self._lock:
+            for follower, followed in pairs:
+                self.changes.setdefault(follower, {})[followed] = (following, now)
+            self.recorded += 1
+
+    def record_on_commit(self, session, pairs, following):
+        """Record changes once ``session`` commits, and forget them if it rolls back."""
+        session.info.setdefault('follow_changes', []).append((list(pairs), following))
+
+    def _committed(self, session):
+        for pairs, following in session.info.pop('follow_changes', ()):
+            self.record(pairs, following)
+
+    def _rolled_back(self, session, previous_transaction):
+        if not previous_transaction.nested:
+            session.info.pop('follow_changes', None)
+
+    def version(self):
+        """A value that changes whenever the suggestions may have, for page ETags."""
+        if not self.app.config['SUGGESTIONS']:
+            return None
+        self.refresh()
+        return self.graph.built_at if self.graph else None, self.recorded
+
+    def following(self, user_id):
+        followed = self.graph.following(user_id)
+        changes = self.changes.get(user_id)
+        if not changes:
+            return followed
+        followed = set(followed)
+        for user, (following, _) in list(changes.items()):
+            if following:
+                followed.add(user)
+            else:
+                followed.discard(user)
+        return followed
+
+    def suggest(self, user_id, count=None):
+        """Return up to ``count`` (user id, mutual follows) pairs, best first."""
+        count = self.app.config['SUGGESTIONS'] if count is None else count
+        if not count:
+            return []
+        self.refresh()
+        if self.graph is None:
+            return []
+        following = self.following(user_id)
+        scores = Counter()
+        budget = self.app.config['SUGGESTIONS_MAX_SCAN']
+        for followed in following:
+            row = self.following(followed)
+            scores.update(row)
+            budget -= len(row)
+            if budget <= 0:
+                break
+        for user in following:
+            scores.pop(user, None)
+        scores.pop(user_id, None)
+        return heapq.nsmallest(count, scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def build(self):
+        """Build a FollowGraph from the followers table."""
+        from app import db
+        from app.models import followers
+        built_at = time()
+        query = sa.select(followers.c.follower_id, followers.c.followed_id) \
+            .order_by(followers.c.follower_id, followers.c.followed_id) \
+            .execution_options(yield_per=10000)
+        return FollowGraph.from_edges(db.session.execute(query), built_at)
+
+    def install(self, graph):
+        with self._lock:
+            self.graph = graph
+            # changes made before the build started are already in it
+            self.changes = {follower: kept for follower, kept in (
+                (follower, {user: change for user, change in changes.items()
+                            if change[1] >= graph.built_at})
+                for follower, changes in self.changes.items()) if kept}
+
+    def refresh(self):
+        path = self.app.config['SUGGESTIONS_SNAPSHOT']
+        if path:
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime is not None:
+                if mtime != self._snapshot_mtime:
+                    self.install(FollowGraph.load(path))
+                    self._snapshot_mtime = mtime
+                return
+        # building reads the whole followers table, which requests never wait for
+        if self.graph is None or \
+                time() - self.graph.built_at > self.app.config['SUGGESTIONS_MAX_AGE']:
+            with self._lock:
+                if self._rebuilding:
+                    return
+                self._rebuilding = True
+            self._builder = threading.Thread(target=self._rebuild, daemon=True,
+                                             name='suggestions-build')
+            self._builder.start()
+
+    def _rebuild(self):
+        from app import db
+        try:
+            with self.app.app_context():
+                self.install(self.build())
+                db.session.remove()
+        except Exception:
+            self.app.logger.exception('Follow suggestion graph rebuild failed')
+        finally:
+            self._rebuilding = False
+
+    def metrics(self):
+        graph = self.graph
+        return {'edges': len(graph.targets) if graph else 0,
+                'changes': sum(len(changes) for changes in list(self.changes.values())),
+                'age_seconds': round(time() - graph.built_at, 1) if graph else 0}
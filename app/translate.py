@@ -1,20 +1,133 @@
-import requests
+import hashlib
+import threading
 from flask import current_app
 from flask_babel import _
+import sqlalchemy as sa
+from app import db
+from app.cache import LRUCache
+from app.models import Translation
 
+# the translator accepts up to 100 Text items per request
+BATCH_SIZE = 100
 
-def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
-            not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
+_lock = threading.Lock()
+_session = None
+_cache = None
+
+
+def get_session():
+    # one pooled session per worker so connections to the translator are reused;
+    # requests is slow to import, so only on the first translation
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=current_app.config['TRANSLATOR_POOL_SIZE'])
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def get_cache():
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = LRUCache(maxsize=current_app.config['TRANSLATION_CACHE_SIZE'],
+                              ttl=current_app.config['TRANSLATION_CACHE_TTL'])
+        return _cache
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _load_persistent(digests, source_language, dest_language):
+    query = sa.select(Translation.digest, Translation.text).where(
+        Translation.digest.in_(digests),
+        Translation.source_language == source_language,
+        Translation.dest_language == dest_language)
+    return dict(db.session.execute(query).all())
+
+
+def _save_persistent(translations, source_language, dest_language):
+    try:
+        for digest, text in translations.items():
+            db.session.merge(Translation(digest=digest, source_language=source_language,
+                                         dest_language=dest_language, text=text))
+        db.session.commit()
+    except sa.exc.IntegrityError:
+        # another worker stored the same translation first
+        db.session.rollback()
+
+
+def _request(texts, source_language, dest_language):
     auth = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
         'Ocp-Apim-Subscription-Region': 'westus'
     }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[{'Text': text}])
+    import requests
+    try:
+        r = get_session().post(
+            current_app.config['TRANSLATOR_URL'] +
+            '/translate?api-version=3.0&from={}&to={}'.format(
+                source_language, dest_language), headers=auth,
+            json=[{'Text': text} for text in texts],
+            timeout=current_app.config['TRANSLATOR_TIMEOUT'])
+    except requests.RequestException:
+        return None
     if r.status_code != 200:
+        return None
+    try:
+        translated = [item['translations'][0]['text'] for item in r.json()]
+    except (ValueError, KeyError, IndexError, TypeError):
+        # not the JSON the translator is documented to send
+        return None
+    return translated if len(translated) == len(texts) else None
+
+
+def translate_many(texts, source_language, dest_language):
+    """Translate a list of texts, returning None if the service failed.
+
+    Cached translations are reused and the rest are sent upstream in as few
+    requests as possible.
+    """
+    cache = get_cache()
+    digests = [_digest(text) for text in texts]
+    results = {}
+    for digest in digests:
+        text = cache.get((digest, source_language, dest_language))
+        if text is not None:
+            results[digest] = text
+    missing = [d for d in dict.fromkeys(digests) if d not in results]
+    if missing and current_app.config['TRANSLATION_CACHE_PERSISTENT']:
+        for digest, text in _load_persistent(missing, source_language, dest_language).items():
+            cache.set((digest, source_language, dest_language), text)
+            results[digest] = text
+        missing = [d for d in missing if d not in results]
+    if missing:
+        sources = dict(zip(digests, texts))
+        fetched = {}
+        for i in range(0, len(missing), BATCH_SIZE):
+            chunk = missing[i:i + BATCH_SIZE]
+            translated = _request([sources[d] for d in chunk], source_language, dest_language)
+            if translated is None:
+                return None
+            fetched.update(zip(chunk, translated))
+        for digest, text in fetched.items():
+            cache.set((digest, source_language, dest_language), text)
+        if current_app.config['TRANSLATION_CACHE_PERSISTENT']:
+            _save_persistent(fetched, source_language, dest_language)
+        results.update(fetched)
+    return [results[digest] for digest in digests]
+
+
+def translate(text, source_language, dest_language):
+    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
+            not current_app.config['MS_TRANSLATOR_KEY']:
+        return _('Error: the translation service is not configured.')
+    translated = translate_many([text], source_language, dest_language)
+    if translated is None:
         return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
+    return translated[0]
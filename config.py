@@ -6,15 +6,124 @@ load_dotenv(os.path.join(basedir, '.env'))
 
 
 class Config:
+    # set for 'flask startup' and the tests, which create the app without the
+    # log file and the error emails
+    TESTING = os.environ.get('MICROBLOG_TESTING') is not None
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
+    # pool settings for server databases, SQLite is tuned with pragmas instead
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 10)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20)
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)
+    DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING', '1') != '0'
+    SQLITE_WAL = os.environ.get('SQLITE_WAL', '1') != '0'
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 268435456)
+    # post listings are read from this database when it is set, except for
+    # DATABASE_REPLICA_LAG seconds after the user wrote something
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    DATABASE_REPLICA_LAG = int(os.environ.get('DATABASE_REPLICA_LAG') or 5)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    # password hashes are upgraded on login when the method changes, and
+    # checked in a pool of PASSWORD_HASH_WORKERS threads (0 checks inline)
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:600000'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 4)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
+    # login and password reset attempts per IP and per account, 0 turns it off
+    RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST') or 10)
+    RATE_LIMIT_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_MINUTE') or 5)
+    # number of reverse proxies in front of the app, whose X-Forwarded-For and
+    # X-Forwarded-Proto headers are trusted for the client address and scheme
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 0)
+    # background jobs such as email are run by 'flask worker'
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 4)
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS') or 5)
+    JOB_RETRY_BACKOFF = int(os.environ.get('JOB_RETRY_BACKOFF') or 30)
+    JOB_LEASE = int(os.environ.get('JOB_LEASE') or 300)
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL') or 1)
+    # seconds done jobs are kept before workers delete them
+    JOB_RETENTION = int(os.environ.get('JOB_RETENTION') or 86400)
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_URL = os.environ.get('TRANSLATOR_URL') or \
+        'https://api.cognitive.microsofttranslator.com'
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5)
+    TRANSLATOR_POOL_SIZE = int(os.environ.get('TRANSLATOR_POOL_SIZE') or 10)
+    TRANSLATION_CACHE_SIZE = int(os.environ.get('TRANSLATION_CACHE_SIZE') or 4096)
+    TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL') or 86400)
+    # also keep translations in the database so they survive restarts
+    TRANSLATION_CACHE_PERSISTENT = os.environ.get('TRANSLATION_CACHE_PERSISTENT') is not None
     POSTS_PER_PAGE = 25
+    # per request SQL and render timings in a Server-Timing header, the log
+    # and /metrics; PROFILE_SAMPLE_RATE of the requests are also profiled
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION') is not None
+    SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD') or 100)
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'cache', 'profiles')
+    # serve avatars from /avatar, cached on disk, instead of linking to gravatar
+    AVATAR_PROXY = os.environ.get('AVATAR_PROXY') is not None
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR') or \
+        os.path.join(basedir, 'cache', 'avatars')
+    AVATAR_TIMEOUT = float(os.environ.get('AVATAR_TIMEOUT') or 3)
+    AVATAR_MAX_AGE = int(os.environ.get('AVATAR_MAX_AGE') or 31536000)
+    # the sizes the templates ask for, and how many images the cache keeps
+    AVATAR_SIZES = (24, 70, 128)
+    AVATAR_CACHE_LIMIT = int(os.environ.get('AVATAR_CACHE_LIMIT') or 10000)
+    # logged in users are loaded from memory for this many seconds, and with
+    # LOGIN_SESSION_SNAPSHOT from the signed session cookie on GET requests
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 30)
+    IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 10000)
+    LOGIN_SESSION_SNAPSHOT = os.environ.get('LOGIN_SESSION_SNAPSHOT') is not None
+    # rendered posts are cached in memory, or also on disk with 'filesystem'
+    # so all workers can share them; 'none' turns the cache off
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND') or 'memory'
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 5000)
+    FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR') or \
+        os.path.join(basedir, 'cache', 'fragments')
+    # the most fragment files kept in FRAGMENT_CACHE_DIR, oldest are deleted first
+    FRAGMENT_CACHE_DIR_LIMIT = int(os.environ.get('FRAGMENT_CACHE_DIR_LIMIT') or 100000)
+    # 'fts5', 'inverted' or 'auto' to use SQLite FTS5 when it is available
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'auto'
+    # load the langdetect profiles at startup and optionally detect post
+    # languages in a background pool after the post is saved
+    LANGUAGE_PRELOAD = os.environ.get('LANGUAGE_PRELOAD', '1') != '0'
+    LANGUAGE_DETECT_ASYNC = os.environ.get('LANGUAGE_DETECT_ASYNC') is not None
+    LANGUAGE_DETECT_WORKERS = int(os.environ.get('LANGUAGE_DETECT_WORKERS') or 2)
+    LANGUAGE_CACHE_SIZE = int(os.environ.get('LANGUAGE_CACHE_SIZE') or 10000)
+    # last_seen is only written when it is older than this many seconds,
+    # and buffered writes are flushed in one batch every interval
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 10)
+    # authors with more followers than this are merged into timelines at read time
+    TIMELINE_FANOUT_THRESHOLD = int(os.environ['TIMELINE_FANOUT_THRESHOLD']) \
+        if os.environ.get('TIMELINE_FANOUT_THRESHOLD') else None
+    TIMELINE_BACKFILL_LIMIT = int(os.environ.get('TIMELINE_BACKFILL_LIMIT') or 500)
+    # number of "who to follow" suggestions, 0 turns them off; the follow graph
+    # they come from is loaded from SUGGESTIONS_SNAPSHOT when 'flask suggestions
+    # rebuild' has written one, or else rebuilt every SUGGESTIONS_MAX_AGE seconds
+    SUGGESTIONS = int(os.environ.get('SUGGESTIONS') or 5)
+    SUGGESTIONS_SNAPSHOT = os.environ.get('SUGGESTIONS_SNAPSHOT')
+    SUGGESTIONS_MAX_AGE = int(os.environ.get('SUGGESTIONS_MAX_AGE') or 3600)
+    # follows read for one suggestion, which bounds the time taken for users
+    # who follow many popular accounts
+    SUGGESTIONS_MAX_SCAN = int(os.environ.get('SUGGESTIONS_MAX_SCAN') or 200000)
+    # new posts are pushed to the home page of followers over /events; each open
+    # page holds a server thread, so this is off unless EVENTS is set. Use the
+    # 'database' broker when the app runs in more than one process
+    EVENTS = os.environ.get('EVENTS') is not None
+    EVENTS_BROKER = os.environ.get('EVENTS_BROKER') or 'local'
+    EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE') or 100)
+    EVENTS_MAX_SUBSCRIBERS = int(os.environ.get('EVENTS_MAX_SUBSCRIBERS') or 1000)
+    EVENTS_KEEPALIVE = int(os.environ.get('EVENTS_KEEPALIVE') or 15)
+    EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL') or 1)
+    EVENTS_RETENTION = int(os.environ.get('EVENTS_RETENTION') or 300)
+    # posts older than this many days are moved to monthly archive tables by
+    # 'flask archive run', ARCHIVE_BATCH_SIZE at a time; 0 keeps every post in place
+    POST_RETENTION_DAYS = int(os.environ.get('POST_RETENTION_DAYS') or 0)
+    ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or 1000)
@@ -1,11 +1,12 @@
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 from app import create_app, db
-from app.models import User, Post
+from app.models import User, Post, Timeline
 
 app = create_app()
 
 # allows the commands to be used in 'flask shell' for debugging and database management 
 @app.shell_context_processor
 def make_shell_context():
-    return {'sa': sa, 'so': so, 'db': db, 'User': User, 'Post': Post}
+    return {'sa': sa, 'so': so, 'db': db, 'User': User, 'Post': Post,
+            'Timeline': Timeline}
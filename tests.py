@@ -2,18 +2,77 @@ import os
 os.environ['DATABASE_URL'] = 'sqlite://'
 from config import Config
 from datetime import datetime, timezone, timedelta
+import gzip
+import json
+import random
+import re
+import socket
+import sqlite3
+import tempfile
+import threading
 import unittest
-from app import app, db
-from app.models import User, Post
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import sqlalchemy as sa
+from flask import request
+from app import create_app, db, last_seen_tracker, language_detector, fragment_cache, \
+    identity_cache, follow_suggestions, event_stream
+from app.models import User, Post, Timeline, PostPartition
+from app.pagination import cursor_paginate
+from app.translate import translate, translate_many, get_cache
+from app.email import send_email
+from app.auth.email import send_password_reset_email
+from app.jobs import Worker, enqueue, job
+from app.models import Job, Event
+from app.search import FTS5Index, InvertedIndex
+from app import bench
+from app.follows import apply as apply_follows, read_pairs
+from app.suggestions import FollowGraph
+from app.events import DatabaseBroker
+from app.export import batches
+from app.passwords import PasswordCheckBusy
+from app.startup import LAZY_MODULES, import_times
+from app.cache import evict_files
+from app.fragments import FileFragmentStore
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    LANGUAGE_PRELOAD = False
+    # the graph is built in a thread, which must not share the test connection
+    SUGGESTIONS = 0
+
+class RouteTestConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+
+class ReplicaTestConfig(RouteTestConfig):
+    DATABASE_REPLICA_URL = 'sqlite://'
+
+
+class QueryCounter:
+    # counts the SQL statements sent to the database while active
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _count(self, conn, cursor, statement, parameters, *args):
+        self.count += 1
+        self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        sa.event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *args):
+        sa.event.remove(self.engine, 'before_cursor_execute', self._count)
+
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
-        self.app_context = app.app_context()
+        self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
 
@@ -28,11 +87,27 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertFalse(u.password_needs_rehash())
+        self.app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+        self.assertTrue(u.password_needs_rehash())
+        self.assertTrue(u.check_password('cat'))
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+        # the digest is stored and follows email changes
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'John@Example.com '.strip()
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertNotEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -48,8 +123,8 @@ class UserModelCase(unittest.TestCase):
         u1.follow(u2)
         db.session.commit()
         self.assertTrue(u1.is_following(u2))
-        self.assertEqual(u1.following_count(), 1)
-        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.followers_count, 1)
         u1_following = db.session.scalars(u1.following.select()).all()
         u2_followers = db.session.scalars(u2.followers.select()).all()
         self.assertEqual(u1_following[0].username, 'susan')
@@ -58,8 +133,8 @@ class UserModelCase(unittest.TestCase):
         u1.unfollow(u2)
         db.session.commit()
         self.assertFalse(u1.is_following(u2))
-        self.assertEqual(u1.following_count(), 0)
-        self.assertEqual(u2.followers_count(), 0)
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(u2.followers_count, 0)
 
     def test_follow_posts(self):
         # create four users
@@ -95,6 +170,1159 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_repair_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2, Post(body='post from susan', author=u2)])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(User.repair_counters(dry_run=True), 1)
+        self.assertEqual(User.repair_counters(), 1)
+        db.session.commit()
+        self.assertEqual(User.repair_counters(dry_run=True), 0)
+        self.assertEqual((u2.followers_count, u2.post_count), (1, 1))
+
+    def test_last_seen_tracker(self):
+        u = User(username='john', email='john@example.com',
+                 last_seen=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.now(timezone.utc)
+        last_seen_tracker.touch(u, now=now)
+        # touches within the granularity are coalesced
+        last_seen_tracker.touch(u, now=now + timedelta(seconds=1))
+        self.assertEqual(last_seen_tracker.metrics()['pending'], 1)
+        self.assertEqual(last_seen_tracker.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(u.last_seen, now.replace(tzinfo=None))
+        last_seen_tracker.touch(u, now=now + timedelta(seconds=1))
+        self.assertEqual(last_seen_tracker.metrics(),
+                         {'pending': 0, 'flushed': 1, 'flushes': 1})
+        # a cached copy of the user with the old timestamp is not written again
+        stale = User(id=u.id, last_seen=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        last_seen_tracker.touch(stale, now=now + timedelta(seconds=2))
+        self.assertEqual(last_seen_tracker.metrics()['pending'], 0)
+
+    def test_language_detection(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='this is a post written in english', author=u)
+        p2 = Post(body='esta es una publicación escrita en español', author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(language_detector.detect(p1.body), 'en')
+        self.assertEqual(language_detector.cache.hits, 0)
+        self.assertEqual(language_detector.detect(p1.body), 'en')
+        self.assertEqual(language_detector.cache.hits, 1)
+
+        # background detection fills in the language after commit
+        self.assertEqual(language_detector.detect_later(p2.id, p2.body).result(), 'es')
+        db.session.expire_all()
+        self.assertEqual(p2.language, 'es')
+
+        result = self.app.test_cli_runner().invoke(
+            args=['language', 'backfill', '--workers', '1'])
+        self.assertEqual(result.exit_code, 0)
+        db.session.expire_all()
+        self.assertEqual(p1.language, 'en')
+
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from susan", author=u2, timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.flush()
+        Timeline.fan_out(p1)
+        db.session.commit()
+
+        # following backfills existing posts, new posts are fanned out
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        p2 = Post(body="post from mary", author=u3, timestamp=now + timedelta(seconds=2))
+        db.session.add(p2)
+        db.session.flush()
+        Timeline.fan_out(p2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p2, p1])
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(),
+                         db.session.scalars(u1.following_posts()).all())
+
+        # unfollowing prunes the timeline
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p2])
+
+        # hybrid mode reads posts of popular authors at request time
+        self.app.config['TIMELINE_FANOUT_THRESHOLD'] = 0
+        Timeline.rebuild()
+        db.session.commit()
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(
+            Timeline).where(Timeline.user_id == u1.id)), 0)
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p2])
+
+    def test_bulk_follows(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        p = Post(body='post from susan', author=u2)
+        db.session.add_all([u1, u2, u3, p])
+        db.session.commit()
+        Timeline.rebuild()
+        u1.follow(u3)
+        db.session.commit()
+
+        # existing follows, repeats, self follows and unknown users change nothing
+        pairs = [('john', 'susan'), ('john', 'mary'), ('john', 'susan'),
+                 ('mary', 'mary'), ('mary', 'david'), ('mary', 'susan')]
+        self.assertEqual(apply_follows(pairs, chunk_size=4), (6, 2))
+        db.session.expire_all()
+        self.assertEqual((u1.following_count, u2.followers_count, u3.following_count), (2, 2, 1))
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p])
+        self.assertEqual(apply_follows(pairs), (6, 0))
+
+        self.assertEqual(apply_follows([(u1.id, u2.id), (u1.id, u2.id)], unfollow=True,
+                                       by='id'), (2, 1))
+        db.session.expire_all()
+        self.assertEqual((u1.following_count, u2.followers_count), (1, 1))
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [])
+        self.assertEqual(User.repair_counters(dry_run=True), 0)
+
+    def test_bulk_follows_timeline(self):
+        self.app.config['TIMELINE_BACKFILL_LIMIT'] = 2
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        now = datetime.now(timezone.utc)
+        p2 = [Post(body='susan {}'.format(i), author=u2, timestamp=now - timedelta(minutes=i))
+              for i in range(3)]
+        p3 = Post(body='post from mary', author=u3, timestamp=now - timedelta(hours=1))
+        db.session.add_all([u1, u2, u3, p3] + p2)
+        db.session.commit()
+        Timeline.rebuild()
+
+        # only the newest TIMELINE_BACKFILL_LIMIT posts of each new author are added
+        self.assertEqual(apply_follows([(u1.id, u2.id), (u1.id, u3.id), ('x', u2.id)],
+                                       by='id'), (3, 2))
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), p2[:2] + [p3])
+
+        # an unfollow removes that author's posts and keeps the others
+        self.assertEqual(apply_follows([('john', 'susan')], unfollow=True), (1, 1))
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p3])
+
+    def test_follow_suggestions(self):
+        self.app.config['SUGGESTIONS'] = 5
+        john, susan, mary, david, anna = [
+            User(username=name, email=name + '@example.com')
+            for name in ('john', 'susan', 'mary', 'david', 'anna')]
+        db.session.add_all([john, susan, mary, david, anna])
+        db.session.commit()
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(david)
+        mary.follow(david)
+        mary.follow(anna)
+        mary.follow(john)
+        db.session.commit()
+        # the graph is built in the background, with no suggestions until it is done
+        self.assertEqual(follow_suggestions.suggest(john.id), [])
+        follow_suggestions._builder.join(5)
+        self.assertEqual(follow_suggestions.suggest(john.id),
+                         [(david.id, 2), (anna.id, 1)])
+
+        # changes apply to the graph once committed, and are dropped once a rebuild has them
+        john.follow(anna)
+        self.assertEqual(follow_suggestions.changes, {})
+        db.session.rollback()
+        self.assertEqual(follow_suggestions.suggest(john.id), [(david.id, 2), (anna.id, 1)])
+        john.follow(anna)
+        susan.unfollow(david)
+        db.session.commit()
+        self.assertEqual(follow_suggestions.suggest(john.id), [(david.id, 1)])
+        follow_suggestions.install(follow_suggestions.build())
+        self.assertEqual(follow_suggestions.changes, {})
+        self.assertEqual(follow_suggestions.suggest(john.id), [(david.id, 1)])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'suggestions.bin')
+            follow_suggestions.graph.save(path)
+            graph = FollowGraph.load(path)
+        self.assertEqual(list(graph.following(mary.id)), [john.id, david.id, anna.id])
+        self.assertEqual(list(graph.following(anna.id + 1)), [])
+
+    def test_export_resume(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body='post {}'.format(i), author=u,
+                                 timestamp=now + timedelta(seconds=i)) for i in range(5)])
+        db.session.commit()
+
+        def interrupted(*args, **kwargs):
+            # the export dies after two batches, in the middle of writing a third
+            for text, count, checkpoint in list(batches(*args, **kwargs))[:2]:
+                yield text, count, checkpoint
+            with open(output, 'ab') as f:
+                f.write(b'half a batch')
+            raise RuntimeError()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'posts.jsonl.gz')
+            runner = self.app.test_cli_runner()
+            with mock.patch('app.cli.batches', interrupted):
+                result = runner.invoke(args=['export', 'posts', '--user', 'john',
+                                             '--output', output, '--batch-size', '2'])
+            self.assertIsInstance(result.exception, RuntimeError)
+            result = runner.invoke(args=['export', 'posts', '--output', output, '--resume'])
+            self.assertIn('checkpoint is for an export of posts by john', result.output)
+            result = runner.invoke(args=['export', 'posts', '--user', 'john', '--output', output,
+                                         '--resume', '--batch-size', '2'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertFalse(os.path.exists(output + '.checkpoint'))
+            with gzip.open(output, 'rt') as f:
+                exported = [json.loads(line) for line in f]
+        self.assertEqual([row['body'] for row in exported],
+                         ['post {}'.format(i) for i in range(5)])
+        self.assertEqual(exported[0]['author'], 'john')
+
+    def test_read_pairs(self):
+        lines = ['follower,followed', 'john, susan', 'mary,john', '']
+        self.assertEqual(list(read_pairs(lines, 'csv')), [('john', 'susan'), ('mary', 'john')])
+        lines = ['{"follower": "john", "followed": "susan"}', '', '["mary", "john"]']
+        self.assertEqual(list(read_pairs(lines, 'jsonl')), [('john', 'susan'), ('mary', 'john')])
+        with self.assertRaisesRegex(ValueError, 'line 2'):
+            list(read_pairs(['john,susan', 'mary'], 'csv'))
+        with self.assertRaisesRegex(ValueError, 'line 1'):
+            list(read_pairs(['["john"]'], 'jsonl'))
+
+
+class PaginationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cursor_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        # two posts share a timestamp so the id has to break the tie
+        posts = [Post(body='post {}'.format(i), author=u,
+                      timestamp=now + timedelta(seconds=min(i, 5)))
+                 for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+        query = sa.select(Post)
+        columns = (Post.timestamp, Post.id)
+
+        page1 = cursor_paginate(query, columns, per_page=3)
+        self.assertEqual(page1.items, newest[:3])
+        self.assertFalse(page1.has_prev)
+        page2 = cursor_paginate(query, columns, cursor=page1.next_cursor, per_page=3)
+        self.assertEqual(page2.items, newest[3:6])
+        page3 = cursor_paginate(query, columns, cursor=page2.next_cursor, per_page=3)
+        self.assertEqual(page3.items, newest[6:])
+        self.assertFalse(page3.has_next)
+        back = cursor_paginate(query, columns, cursor=page3.prev_cursor, per_page=3)
+        self.assertEqual(back.items, newest[3:6])
+        self.assertTrue(back.has_prev)
+
+        # old ?page=N links and broken tokens still work
+        self.assertEqual(cursor_paginate(query, columns, page=2, per_page=3).items, newest[3:6])
+        self.assertEqual(cursor_paginate(query, columns, cursor='garbage', per_page=3).items,
+                         newest[:3])
+
+
+class RouteCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(RouteTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        last_seen_tracker.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def request(self, method, url, **kwargs):
+        # requests run in their own app context, like they would in production;
+        # streamed bodies are read before the test's context is pushed back
+        self.app_context.pop()
+        try:
+            return self.client.open(url, method=method, buffered=True, **kwargs)
+        finally:
+            self.app_context.push()
+
+    def add_user(self, username):
+        u = User(username=username, email=username + '@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        return u
+
+    def login(self, username):
+        self.request('POST', '/auth/login', data={'username': username, 'password': 'cat'})
+
+    def add_posts(self, start, count):
+        now = datetime.now(timezone.utc)
+        for i in range(start, start + count):
+            author = User(username='author{}'.format(i), email='author{}@example.com'.format(i))
+            db.session.add(Post(body='post {}'.format(i), author=author,
+                                timestamp=now - timedelta(seconds=i)))
+        db.session.commit()
+
+    def queries_for(self, url):
+        with QueryCounter(db.engine) as counter:
+            response = self.request('GET', url)
+        self.assertEqual(response.status_code, 200)
+        return counter.count
+
+    def test_explore_queries_do_not_grow_with_posts(self):
+        self.add_user('john')
+        self.login('john')
+        self.add_posts(0, 1)
+        self.request('GET', '/explore')
+        one_post = self.queries_for('/explore')
+        self.add_posts(1, 24)
+        full_page = self.queries_for('/explore')
+        self.assertEqual(full_page, one_post)
+        self.assertLessEqual(full_page, 6)
+
+    def test_fragment_cache(self):
+        self.add_user('john')
+        self.login('john')
+        self.add_posts(0, 3)
+        self.request('GET', '/explore')
+        self.assertEqual(fragment_cache.metrics()['misses'], 3)
+        # fragments are cached separately for each locale
+        self.request('GET', '/explore', headers={'Accept-Language': 'es'})
+        self.assertEqual(fragment_cache.metrics()['misses'], 6)
+        self.request('GET', '/explore')
+        self.assertEqual(fragment_cache.metrics()['hits'], 3)
+
+    def test_identity_cache(self):
+        self.add_user('john')
+        self.login('john')
+        self.request('GET', '/explore')
+        with QueryCounter(db.engine) as counter:
+            self.request('GET', '/explore')
+        # only the ETag validator and the post list run, the user comes from the identity cache
+        self.assertEqual(counter.count, 2)
+        self.request('POST', '/edit_profile', data={'username': 'johnny', 'about_me': 'hi'})
+        response = self.request('GET', '/explore')
+        self.assertIn('Hi, johnny!', response.get_data(as_text=True))
+
+    def test_who_to_follow(self):
+        self.app.config['SUGGESTIONS'] = 5
+        susan = self.add_user('susan')
+        john = self.add_user('john')
+        self.add_user('mary')
+        john.follow(susan)
+        db.session.commit()
+        follow_suggestions.install(follow_suggestions.build())
+        self.login('john')
+        tags = {}
+        for url in ('/index', '/user/john'):
+            response = self.request('GET', url)
+            self.assertNotIn('Who to follow', response.get_data(as_text=True))
+            tags[url] = response.get_etag()[0]
+        self.request('GET', '/auth/logout')
+        self.login('susan')
+        self.request('POST', '/follow/mary', data={})
+        self.request('GET', '/auth/logout')
+        self.login('john')
+        # a change to the follow graph is not hidden behind a 304
+        for url in ('/index', '/user/john'):
+            response = self.request('GET', url, headers={'If-None-Match': 'W/"{}"'.format(tags[url])})
+            self.assertEqual(response.status_code, 200)
+            page = response.get_data(as_text=True)
+            self.assertIn('Who to follow', page)
+            self.assertIn('followed by 1 person you follow', page)
+        self.assertNotIn('Who to follow', self.request('GET', '/user/susan').get_data(as_text=True))
+
+    def test_new_post_events(self):
+        self.app.config['EVENTS'] = True
+        susan = self.add_user('susan')
+        john = self.add_user('john')
+        john.follow(susan)
+        db.session.commit()
+        self.login('john')
+        self.assertIn('new-posts', self.request('GET', '/index').get_data(as_text=True))
+        self.app_context.pop()
+        try:
+            response = self.client.get('/events')
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            chunks = iter(response.response)
+            self.assertEqual(next(chunks), b'retry: 5000\n\n')
+            author = self.app.test_client()
+            author.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+            author.post('/index', data={'post': 'hello'})
+            event = next(chunks).decode()
+            self.assertTrue(event.startswith('event: posts\n'))
+            self.assertEqual(json.loads(event.split('data: ')[1])['count'], 1)
+            response.close()
+        finally:
+            self.app_context.push()
+        self.assertEqual(event_stream.metrics()['subscribers'], 0)
+
+    def test_events_unsubscribe_unread(self):
+        self.add_user('john')
+        self.login('john')
+        self.assertEqual(self.request('GET', '/events').status_code, 404)
+        self.assertNotIn('new-posts', self.request('GET', '/index').get_data(as_text=True))
+        self.app.config['EVENTS'] = True
+        self.app_context.pop()
+        try:
+            # streams that are never read still give their place back
+            for _ in range(3):
+                self.client.head('/events').close()
+            self.client.get('/events').close()
+        finally:
+            self.app_context.push()
+        self.assertEqual(event_stream.metrics()['subscribers'], 0)
+
+    def test_export(self):
+        self.add_user('susan')
+        john = self.add_user('john')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body='post {}'.format(i), author=john,
+                                 timestamp=now + timedelta(seconds=i)) for i in range(3)])
+        db.session.commit()
+        self.login('john')
+        response = self.request('GET', '/user/john/export')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(response.data).splitlines()]
+        self.assertEqual([row['body'] for row in rows], ['post 0', 'post 1', 'post 2'])
+        checkpoint = '{},{}'.format(rows[0]['timestamp'], rows[0]['id'])
+        response = self.request('GET', '/user/john/export', query_string={'after': checkpoint,
+                                                                          'format': 'csv'})
+        lines = gzip.decompress(response.data).decode().splitlines()
+        self.assertEqual(lines[0], 'id,timestamp,author,body,language')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.request('GET', '/user/john/export?after=junk').status_code, 400)
+        self.assertEqual(self.request('GET', '/user/susan/export').status_code, 403)
+
+    def test_archive(self):
+        john = self.add_user('john')
+        john_id = john.id
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body='new {}'.format(i), author=john,
+                                 timestamp=now - timedelta(minutes=i)) for i in range(20)])
+        db.session.add_all([Post(body='old {}'.format(i), author=john,
+                                 timestamp=now - timedelta(days=400 + 5 * i)) for i in range(10)])
+        db.session.commit()
+        User.repair_counters()
+        db.session.commit()
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['archive', 'run', '--days', '365', '--dry-run'])
+        self.assertIn('10 posts older than', result.output)
+        self.app.config['ARCHIVE_BATCH_SIZE'] = 4
+        result = runner.invoke(args=['archive', 'run', '--days', '365'])
+        self.assertIn('archive job queued', result.output)
+        self.assertEqual(Worker(self.app).run_once(), 3)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Post)), 20)
+        self.assertEqual(sum(db.session.scalars(sa.select(PostPartition.post_count))), 10)
+        self.assertEqual(User.repair_counters(dry_run=True), 0)
+        self.assertIn('post table  20 posts', runner.invoke(args=['archive', 'report']).output)
+
+        # the profile pages on into the archive tables
+        self.login('john')
+        first = self.request('GET', '/user/john')
+        page = first.get_data(as_text=True)
+        self.assertIn('new 19', page)
+        self.assertIn('old 4', page)
+        self.assertNotIn('old 5', page)
+        second = self.request('GET', self.cursor_url(first))
+        page = second.get_data(as_text=True)
+        self.assertIn('old 5', page)
+        self.assertIn('old 9', page)
+        self.assertNotIn('old 4', page)
+        back = self.request('GET', self.cursor_url(second)).get_data(as_text=True)
+        self.assertIn('new 0', back)
+        self.assertIn('old 4', back)
+        # old page links, the API and exports include the archived posts too
+        page = self.request('GET', '/user/john?page=2').get_data(as_text=True)
+        self.assertIn('old 5', page)
+        self.assertNotIn('old 4', page)
+        response = self.request('GET', '/api/v1/users/john/posts').get_json()
+        self.assertEqual(len(response['posts']), 25)
+        response = self.request('GET', '/api/v1/users/john/posts?cursor=' +
+                                response['next_cursor']).get_json()
+        self.assertEqual([post['body'] for post in response['posts']],
+                         ['old {}'.format(i) for i in range(5, 10)])
+        self.assertIsNone(response['next_cursor'])
+        exported = ''.join(text for text, _, _ in batches('posts', 'jsonl', user_id=john_id,
+                                                          batch_size=7))
+        bodies = [json.loads(line)['body'] for line in exported.splitlines()]
+        self.assertEqual(bodies, ['old {}'.format(i) for i in range(9, -1, -1)] +
+                         ['new {}'.format(i) for i in range(19, -1, -1)])
+
+    def test_session_snapshot(self):
+        self.app.config['LOGIN_SESSION_SNAPSHOT'] = True
+        self.add_user('john')
+        self.login('john')
+        self.request('GET', '/explore')
+        identity_cache.cache.clear()
+        with QueryCounter(db.engine) as counter:
+            response = self.request('GET', '/explore')
+        self.assertEqual(counter.count, 2)
+        self.assertIn('Hi, john!', response.get_data(as_text=True))
+
+    def test_login_rehashes_password(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        self.add_user('john')
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.login('john')
+        user = db.session.scalar(sa.select(User).where(User.username == 'john'))
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(user.check_password('cat'))
+
+    def test_login_rate_limit(self):
+        self.app.config['RATE_LIMIT_BURST'] = 3
+        self.add_user('john')
+        for i in range(3):
+            response = self.request('POST', '/auth/login',
+                                    data={'username': 'john', 'password': 'dog'})
+            self.assertEqual(response.status_code, 302)
+        response = self.request('POST', '/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(response.retry_after, datetime.now(timezone.utc))
+        # the same account from another address is limited too
+        response = self.request('POST', '/auth/login', data={'username': 'John', 'password': 'cat'},
+                                environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 429)
+        response = self.request('POST', '/auth/login', data={'username': 'susan', 'password': 'x'},
+                                environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 302)
+        # other forms have their own buckets
+        response = self.request('POST', '/auth/reset_password_request',
+                                data={'email': 'nobody@example.com'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_translate_posts_validation(self):
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.add_user('john')
+        self.login('john')
+        for body in (None, [], {'post_ids': [1]}, {'post_ids': ['x'], 'dest_language': 'en'},
+                     {'post_ids': 1, 'dest_language': 'en'}, {'post_ids': [1], 'dest_language': 5}):
+            response = self.request('POST', '/translate/batch', json=body)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.get_json())
+        response = self.request('POST', '/translate/batch', data='not json')
+        self.assertEqual(response.status_code, 400)
+        response = self.request('POST', '/translate/batch', json={'post_ids': [],
+                                                                 'dest_language': 'en'})
+        self.assertEqual(response.get_json(), {'translations': {}})
+
+    def test_login_busy(self):
+        self.add_user('john')
+        with mock.patch('app.models.passwords.check_password', side_effect=PasswordCheckBusy):
+            response = self.request('POST', '/auth/login',
+                                    data={'username': 'john', 'password': 'cat'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertIn('Server Busy', response.get_data(as_text=True))
+
+    def test_trusted_proxies(self):
+        class ProxyConfig(RouteTestConfig):
+            TRUSTED_PROXIES = 1
+
+        app = create_app(ProxyConfig)
+        app.add_url_rule('/address', 'address', lambda: request.remote_addr)
+        response = app.test_client().get('/address', headers={'X-Forwarded-For': '203.0.113.7'},
+                                         environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.get_data(as_text=True), '203.0.113.7')
+
+    def test_api(self):
+        self.assertEqual(self.request('GET', '/api/v1/explore').status_code, 401)
+        self.add_user('john')
+        susan = self.add_user('susan')
+        self.add_posts(0, 5)
+        self.login('john')
+
+        response = self.request('GET', '/api/v1/explore?per_page=2')
+        # streamed, so the length is not known up front
+        self.assertIsNone(response.content_length)
+        ids = []
+        while True:
+            ids.extend(post['id'] for post in response.json['posts'])
+            if response.json['next_cursor'] is None:
+                break
+            response = self.request('GET', '/api/v1/explore?per_page=2&cursor=' +
+                                    response.json['next_cursor'])
+        newest = db.session.scalars(sa.select(Post.id).order_by(Post.timestamp.desc())).all()
+        self.assertEqual(ids, newest)
+        post = response.json['posts'][0]
+        self.assertEqual(post['author']['username'], 'author4')
+        self.assertEqual(post['body'], 'post 4')
+
+        self.assertEqual(self.request('POST', '/api/v1/users/susan/follow').status_code, 415)
+        self.assertEqual(self.request('POST', '/api/v1/users/john/follow', json={}).status_code,
+                         400)
+        response = self.request('POST', '/api/v1/users/nobody/follow', json={})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json['error'], 'Not Found')
+        db.session.add(Post(body='hello john', author=susan))
+        db.session.commit()
+        response = self.request('POST', '/api/v1/users/susan/follow', json={})
+        self.assertEqual(response.json, {'username': 'susan', 'following': True,
+                                         'followers_count': 1})
+        self.request('POST', '/api/v1/users/author0/follow', json={})
+        response = self.request('GET', '/api/v1/timeline')
+        self.assertEqual([post['body'] for post in response.json['posts']],
+                         ['hello john', 'post 0'])
+        self.request('POST', '/api/v1/users/susan/unfollow', json={})
+        response = self.request('GET', '/api/v1/timeline')
+        self.assertEqual([post['body'] for post in response.json['posts']], ['post 0'])
+        response = self.request('GET', '/api/v1/users/susan/posts')
+        self.assertEqual([post['body'] for post in response.json['posts']], ['hello john'])
+
+    def test_conditional_get(self):
+        self.add_user('john')
+        susan = self.add_user('susan')
+        self.login('john')
+        for url in ('/index', '/explore', '/user/susan'):
+            response = self.request('GET', url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.cache_control.private)
+            self.assertTrue(response.cache_control.no_cache)
+            self.assertIn('Cookie', response.vary)
+            tag = response.get_etag()[0]
+            with QueryCounter(db.engine) as counter:
+                response = self.request('GET', url, headers={'If-None-Match': 'W/"{}"'.format(tag)})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            # only the validator ran
+            self.assertEqual(counter.count, 1)
+
+        response = self.request('GET', '/user/susan')
+        self.request('POST', '/follow/susan')
+        # the flashed message is shown, so that page is not cached
+        flashed = self.request('GET', '/user/susan')
+        self.assertIsNone(flashed.get_etag()[0])
+        followed = self.request('GET', '/user/susan')
+        self.assertNotEqual(followed.get_etag(), response.get_etag())
+
+        response = self.request('GET', '/explore')
+        db.session.add(Post(body='new', author=susan))
+        db.session.commit()
+        fresh = self.request('GET', '/explore', headers={
+            'If-None-Match': 'W/"{}"'.format(response.get_etag()[0])})
+        self.assertEqual(fresh.status_code, 200)
+        self.assertIn('new', fresh.get_data(as_text=True))
+
+    def test_avatar_proxy(self):
+        self.app.config['AVATAR_PROXY'] = True
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.app.config['AVATAR_CACHE_DIR'] = cache_dir
+            u = self.add_user('john')
+            with self.app.test_request_context():
+                url = u.avatar(70)
+            self.assertEqual(url, '/avatar/{}/70'.format(u.avatar_hash))
+            with open(os.path.join(cache_dir, '{}-70'.format(u.avatar_hash)), 'wb') as f:
+                f.write(b'\x89PNG fake image')
+            response = self.request('GET', url)
+            self.assertEqual(response.mimetype, 'image/png')
+            self.assertEqual(response.cache_control.max_age, 31536000)
+            response = self.request('GET', url, headers={'If-None-Match': response.get_etag()[0]})
+            self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.request('GET', '/avatar/nothex/70').status_code, 404)
+        # unknown digests and sizes the pages do not use are not fetched
+        self.assertEqual(self.request('GET', '/avatar/{}/71'.format(u.avatar_hash)).status_code, 404)
+        self.assertEqual(self.request('GET', '/avatar/{}/70'.format('0' * 32)).status_code, 404)
+
+    def test_avatar_backfill(self):
+        self.app.config['AVATAR_PROXY'] = True
+        u = self.add_user('john')
+        digest = u.avatar_hash
+        db.session.execute(sa.update(User).values(avatar_hash=None))
+        db.session.commit()
+        db.session.expire_all()
+        # users from before the column link to gravatar until they are backfilled
+        with self.app.test_request_context():
+            self.assertTrue(u.avatar(70).startswith('https://www.gravatar.com/avatar/' + digest))
+        result = self.app.test_cli_runner().invoke(args=['avatars', 'backfill'])
+        self.assertIn('1 users updated', result.output)
+        db.session.expire_all()
+        with self.app.test_request_context():
+            url = u.avatar(70)
+        self.assertEqual(url, '/avatar/{}/70'.format(digest))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.app.config['AVATAR_CACHE_DIR'] = cache_dir
+            with open(os.path.join(cache_dir, '{}-70'.format(digest)), 'wb') as f:
+                f.write(b'\x89PNG fake image')
+            self.assertEqual(self.request('GET', url).status_code, 200)
+
+    def test_fragment_store_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            store = FileFragmentStore(cache_dir, limit=10)
+            for i in range(25):
+                store.set('post:{}'.format(i), '<p>{}</p>'.format(i))
+                os.utime(store._path('post:{}'.format(i)), (i, i))
+            # trimmed back to the limit every limit // 10 writes
+            self.assertEqual(len(os.listdir(cache_dir)), 10)
+            self.assertIsNone(store.get('post:14'))
+            self.assertEqual(store.get('post:24'), '<p>24</p>')
+
+    def test_avatar_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for i in range(4):
+                path = os.path.join(cache_dir, '{}-70'.format(i))
+                with open(path, 'wb') as f:
+                    f.write(b'\x89PNG')
+                os.utime(path, (i, i))
+            self.assertEqual(evict_files(cache_dir, 2), 2)
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['2-70', '3-70'])
+
+    def test_profile_queries_are_fixed(self):
+        susan = self.add_user('susan')
+        john = self.add_user('john')
+        john.follow(susan)
+        for i in range(25):
+            db.session.add(Post(body='post {}'.format(i), author=susan))
+        db.session.commit()
+        self.login('john')
+        self.assertLessEqual(self.queries_for('/user/susan'), 6)
+
+    def explain(self, url):
+        # every SELECT the page runs must be answered from an index
+        with QueryCounter(db.engine) as counter:
+            response = self.request('GET', url)
+        self.assertEqual(response.status_code, 200)
+        for statement, parameters in counter.statements:
+            if not statement.lstrip().upper().startswith('SELECT'):
+                continue
+            plan = [row[-1] for row in db.session.connection().exec_driver_sql(
+                'EXPLAIN QUERY PLAN ' + statement, parameters)]
+            for step in plan:
+                full_scan = step.startswith('SCAN') and ' USING ' not in step
+                self.assertFalse(full_scan or 'TEMP B-TREE' in step,
+                                 '{}\n{}\n{}'.format(url, statement, '\n'.join(plan)))
+        return response
+
+    def cursor_url(self, response):
+        # the first pagination link, older posts on page one and newer posts after
+        return re.search(r'href="([^"]*cursor=[^"]*)"', response.get_data(as_text=True)) \
+            .group(1).replace('&amp;', '&')
+
+    def test_hot_queries_use_indexes(self):
+        susan = self.add_user('susan')
+        john = self.add_user('john')
+        john.follow(susan)
+        db.session.commit()
+        self.login('susan')
+        for i in range(30):
+            self.request('POST', '/index', data={'post': 'post {}'.format(i)})
+        self.login('john')
+        for url in ('/index', '/explore', '/user/susan'):
+            response = self.explain(url)
+            response = self.explain(self.cursor_url(response))
+            self.explain(self.cursor_url(response))
+        for url in ('/api/v1/timeline', '/api/v1/explore', '/api/v1/users/susan/posts'):
+            cursor = self.explain(url + '?per_page=10').json['next_cursor']
+            self.explain('{}?per_page=10&cursor={}'.format(url, cursor))
+
+
+class BenchCase(unittest.TestCase):
+    def test_seed_and_run(self):
+        app = create_app(RouteTestConfig)
+        rng = random.Random(1)
+        with app.app_context():
+            db.create_all()
+            users, edges = bench.seed(50, 200, follows=5, rng=rng)
+            self.assertEqual(users, 50)
+            self.assertGreater(edges, 0)
+            self.assertEqual(db.session.scalar(sa.select(sa.func.sum(User.post_count))), 200)
+            self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(Timeline)),
+                             db.session.scalar(sa.select(sa.func.sum(User.followers_count))
+                                               .join(Post, Post.user_id == User.id)) + 200)
+        report = bench.run(app, 60, clients=3, rng=rng)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(sum(stats['requests'] for stats in report['routes'].values()), 60)
+        self.assertGreater(report['routes']['index']['queries'], 0)
+        with app.app_context():
+            last_seen_tracker.flush()
+            db.session.remove()
+            db.drop_all()
+
+
+class EventStreamCase(unittest.TestCase):
+    def setUp(self):
+        class EventsConfig(TestConfig):
+            EVENTS_BROKER = 'database'
+            EVENTS_QUEUE_SIZE = 2
+            EVENTS_POLL_INTERVAL = 60
+
+        self.app = create_app(EventsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        event_stream.broker.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_database_broker(self):
+        self.assertIsInstance(event_stream.broker, DatabaseBroker)
+        fan = event_stream.subscribe(1, [2])
+        other = event_stream.subscribe(3, [4])
+        # events published before the first poll are not missed
+        for post_id in (10, 11):
+            event_stream.publish_post(Post(id=post_id, user_id=2))
+        self.assertEqual(event_stream.broker.poll(), 2)
+        self.assertEqual([fan.queue.get_nowait()['post_id'] for _ in range(2)], [10, 11])
+        self.assertTrue(other.queue.empty())
+
+        # a subscriber whose queue is full is dropped
+        for post_id in (12, 13, 14):
+            event_stream.publish_post(Post(id=post_id, user_id=2))
+        event_stream.broker.poll()
+        self.assertTrue(fan.dropped)
+        self.assertEqual(event_stream.metrics(), {'subscribers': 1, 'dropped': 1})
+
+    def test_database_broker_prune(self):
+        db.session.add(Event(payload='{}', timestamp=datetime.now(timezone.utc) - timedelta(hours=1)))
+        db.session.commit()
+        event_stream.publish_post(Post(id=10, user_id=2))
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count(Event.id))), 1)
+
+
+class InstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        self.profiles = tempfile.TemporaryDirectory()
+
+        class InstrumentedConfig(RouteTestConfig):
+            INSTRUMENTATION = True
+            SLOW_QUERY_THRESHOLD = 0
+            PROFILE_SAMPLE_RATE = 1
+            PROFILE_DIR = self.profiles.name
+
+        self.app = create_app(InstrumentedConfig)
+        with self.app.app_context():
+            db.create_all()
+            u = User(username='john', email='john@example.com')
+            u.set_password('cat')
+            db.session.add_all([u, Post(body='hello', author=u)])
+            db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            last_seen_tracker.flush()
+            db.session.remove()
+            db.drop_all()
+        self.profiles.cleanup()
+
+    def test_request_metrics(self):
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        with self.assertLogs(self.app.logger, 'INFO') as logs:
+            response = self.client.get('/explore')
+        self.assertRegex(response.headers['Server-Timing'],
+                         r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries", render;dur=[0-9.]+')
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line['endpoint'], 'main.explore')
+        self.assertEqual(len(line['slow_queries']), line['db_queries'])
+        self.assertGreater(line['render_ms'], 0)
+        self.assertTrue(any(name.startswith('main.explore-')
+                            for name in os.listdir(self.profiles.name)))
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('microblog_http_requests_total{endpoint="main.explore",method="GET",'
+                      'status="200"} 1', text)
+        self.assertIn('microblog_http_request_duration_seconds_count{endpoint="main.explore"} 1',
+                      text)
+        self.assertIn('microblog_db_queries_total{endpoint="main.explore"} ' +
+                      str(float(line['db_queries'])), text)
+        self.assertIn('microblog_fragment_cache_misses 1', text)
+
+
+class StartupCase(unittest.TestCase):
+    # seconds that importing microblog.py, which also creates the app, may take
+    IMPORT_TIME_BUDGET = 2.0
+
+    def test_import_time_budget(self):
+        log = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'microblog.log')
+        size = os.path.getsize(log) if os.path.exists(log) else None
+        times = import_times('import microblog')
+        # the app is created in testing mode, without writing to the log
+        self.assertEqual(os.path.getsize(log) if os.path.exists(log) else None, size)
+        loaded = {module.split('.')[0] for module, _, _ in times}
+        for package in LAZY_MODULES:
+            self.assertNotIn(package, loaded)
+        self.assertLess(sum(own for _, own, _ in times) / 1e6, self.IMPORT_TIME_BUDGET)
+
+
+class DatabaseCase(unittest.TestCase):
+    def test_sqlite_pragmas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            class FileConfig(TestConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'app.db')
+            app = create_app(FileConfig)
+            with app.app_context():
+                with db.engine.connect() as conn:
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+                    self.assertEqual(conn.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+                db.engine.dispose()
+
+    def test_listings_read_from_replica(self):
+        app = create_app(ReplicaTestConfig)
+        client = app.test_client()
+        with app.app_context():
+            db.create_all()
+            replica = db.engines['replica']
+            db.metadata.create_all(replica)
+            for username in ('john', 'susan'):
+                u = User(username=username, email=username + '@example.com')
+                u.set_password('cat')
+                db.session.add(u)
+            db.session.commit()
+            with replica.begin() as conn:
+                conn.execute(sa.insert(User).values(id=1, username='john',
+                                                    email='john@example.com'))
+                conn.execute(sa.insert(Post).values(body='from the replica', user_id=1))
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        self.assertIn(b'from the replica', client.get('/explore').data)
+        self.assertIn(b'from the replica', client.get('/user/john').data)
+        # after a write the user reads their own changes from the primary
+        client.post('/follow/susan')
+        self.assertNotIn(b'from the replica', client.get('/explore').data)
+        with app.app_context():
+            self.assertEqual(db.session.get(User, 1).following_count, 1)
+            db.session.remove()
+
+
+class SearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def check_backend(self, index):
+        u = User(username='john', email='john@example.com')
+        bodies = ['the quick brown fox', 'a lazy dog', 'the quick dog', 'brown bread', 'fox']
+        posts = [Post(body=body, author=u) for body in bodies]
+        db.session.add_all(posts)
+        db.session.flush()
+        for post in posts:
+            index.add(post)
+        db.session.commit()
+
+        page = index.search('quick dog', per_page=2)
+        # the post matching both terms ranks first
+        self.assertEqual(page.items[0], posts[2])
+        rest = index.search('quick dog', cursor=page.next_cursor, per_page=2)
+        self.assertEqual(set(page.items + rest.items), {posts[0], posts[1], posts[2]})
+        self.assertFalse(rest.has_next)
+
+        index.remove([posts[2].id])
+        self.assertNotIn(posts[2], index.search('quick dog').items)
+        self.assertEqual(index.reindex(), 5)
+        self.assertEqual(index.search('"bread').items, [posts[3]])
+
+    def test_inverted_index(self):
+        self.check_backend(InvertedIndex())
+
+    @unittest.skipUnless(sqlite3.connect(':memory:').execute(
+        "SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0], 'FTS5 not available')
+    def test_fts5_index(self):
+        self.check_backend(FTS5Index())
+
+
+class StubTranslator(BaseHTTPRequestHandler):
+    # stands in for the translator API, upper-casing every text it receives,
+    # or answering with ``reply`` when it is set
+    requests = []
+    reply = None
+
+    def do_POST(self):
+        items = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        StubTranslator.requests.append(items)
+        body = StubTranslator.reply or json.dumps(
+            [{'translations': [{'text': item['Text'].upper()}]} for item in items]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TranslateCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubTranslator)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        StubTranslator.requests = []
+        StubTranslator.reply = None
+        self.app = create_app(TestConfig)
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['TRANSLATOR_URL'] = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        get_cache().clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batch_and_cache(self):
+        self.assertEqual(translate_many(['hola', 'adios', 'hola'], 'es', 'en'),
+                         ['HOLA', 'ADIOS', 'HOLA'])
+        self.assertEqual(StubTranslator.requests, [[{'Text': 'hola'}, {'Text': 'adios'}]])
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(len(StubTranslator.requests), 1)
+
+    def test_persistent_cache(self):
+        self.app.config['TRANSLATION_CACHE_PERSISTENT'] = True
+        translate('hola', 'es', 'en')
+        get_cache().clear()
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        self.assertEqual(len(StubTranslator.requests), 1)
+
+    def test_service_failure(self):
+        self.app.config['TRANSLATOR_URL'] = 'http://127.0.0.1:1'
+        with self.app.test_request_context():
+            self.assertEqual(translate('hola', 'es', 'en'),
+                             'Error: the translation service failed.')
+
+    def test_unexpected_reply(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        post = Post(body='hola', author=u, language='es')
+        db.session.add(post)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+        for reply in (b'<html>busy</html>', b'{"error": {}}', b'[{"translations": []}]', b'[]'):
+            StubTranslator.reply = reply
+            with self.app.test_request_context():
+                self.assertEqual(translate('hola', 'es', 'en'),
+                                 'Error: the translation service failed.')
+            response = client.post('/translate/batch', json={'post_ids': [post.id],
+                                                             'dest_language': 'en'})
+            self.assertEqual(response.status_code, 502)
+
+
+class SMTPTestConfig(TestConfig):
+    MAIL_SERVER = '127.0.0.1'
+    MAIL_SUPPRESS_SEND = False
+    JOB_MAX_ATTEMPTS = 2
+
+
+class SMTPRecorder:
+    # aiosmtpd handler that keeps every message and counts connections
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        self.sessions.add(id(session))
+        return '250 OK'
+
+
+@job('flaky')
+def flaky_job(fail):
+    if fail:
+        raise RuntimeError('failed')
+
+
+class JobQueueCase(unittest.TestCase):
+    def setUp(self):
+        from aiosmtpd.controller import Controller
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.smtp = SMTPRecorder()
+        self.controller = Controller(self.smtp, hostname='127.0.0.1', port=port)
+        self.controller.start()
+        self.app = create_app(SMTPTestConfig)
+        self.app.extensions['mail'].port = port
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.controller.stop()
+
+    def test_send_email(self):
+        for i in range(3):
+            send_email('subject {}'.format(i), sender='admin@example.com',
+                       recipients=['susan@example.com'], text_body='text', html_body='<p>html</p>')
+        worker = Worker(self.app, concurrency=1)
+        self.assertEqual(worker.run_once(), 3)
+        self.assertEqual(len(self.smtp.messages), 3)
+        # the SMTP connection is reused between messages
+        self.assertEqual(len(self.smtp.sessions), 1)
+        self.assertEqual(db.session.scalars(sa.select(Job.status)).all(), ['done'] * 3)
+        # done jobs keep no payload and are deleted after JOB_RETENTION
+        self.assertEqual(db.session.scalars(sa.select(Job.payload)).all(), ['{}'] * 3)
+        self.app.config['JOB_RETENTION'] = 0
+        self.assertEqual(worker.prune(), 3)
+
+    def test_password_reset_email(self):
+        user = User(username='susan', email='susan@example.com')
+        db.session.add(user)
+        db.session.commit()
+        with self.app.test_request_context(base_url='http://blog.example.com/',
+                                           headers={'Accept-Language': 'es'}):
+            send_password_reset_email(user)
+        # the job holds the user, the token is only made when the email is sent
+        payload = json.loads(db.session.scalar(sa.select(Job.payload)))
+        self.assertEqual(payload, {'user_id': user.id, 'url_root': 'http://blog.example.com/',
+                                   'locale': 'es'})
+        self.assertEqual(Worker(self.app, concurrency=1).run_once(), 1)
+        message = self.smtp.messages[0].content.decode()
+        token = re.search(r'http://blog\.example\.com/auth/reset_password/([\w.-]+)',
+                          message).group(1)
+        self.assertEqual(User.verify_reset_password_token(token), user)
+
+    def test_retry(self):
+        failing = enqueue('flaky', fail=True)
+        worker = Worker(self.app, concurrency=1)
+        worker.run_once()
+        db.session.expire_all()
+        self.assertEqual((failing.status, failing.attempts), ('queued', 1))
+        self.assertGreater(failing.run_at, datetime.now(timezone.utc).replace(tzinfo=None))
+        failing.run_at = datetime.now(timezone.utc)
+        db.session.commit()
+        worker.run_once()
+        db.session.expire_all()
+        self.assertEqual((failing.status, failing.attempts), ('failed', 2))
+        self.assertIn('RuntimeError', failing.last_error)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file